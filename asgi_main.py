@@ -0,0 +1,135 @@
+"""
+The async serving mode of flask_main_cli.py, an ASGI application with the same '/<api>' and '/<api>/change' apis.
+The features are searched with AsyncFHIRClient, so one process could wait for many patients' searches at the same
+time instead of blocking one worker thread for each request. The sync Flask app is still the default.
+
+Run with an ASGI server, e.g. `uvicorn asgi_main:app --port 5000`
+"""
+import json
+import traceback
+
+from urllib.parse import parse_qs
+from base import patient_data_search as ds
+from base.records import to_json
+from flask_main_cli import table
+from flask_main_cli import verify_data
+from flask_main_cli import return_model_result
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, description: str):
+        self.status = status
+        self.description = description
+        super().__init__(description)
+
+
+async def api_with_id(api: str, query: dict, body: bytes) -> dict:
+    """
+    Same as flask_main_cli.api_with_id()
+    :param api:<base>/<model name>?id=<patient's id>&hour_alive_time
+    """
+    # TODO: the hour_alive_time request value
+    if query.get('id') is None:
+        raise HTTPError(400, "Please fill in patient's ID.")
+    patient_id = query.get('id')
+    hour_alive_time = None
+
+    if query.get('data_alive_time') is not None:
+        hour_alive_time = query.get('hour_alive_time')
+
+    patient_data_dictionary = await ds.async_model_feature_search_with_patient_id(
+        patient_id, table.get_model_feature_dict(api), None, hour_alive_time)
+    print(patient_data_dictionary)
+    patient_data_dictionary["predict_value"] = return_model_result(patient_data_dictionary, api)
+    return patient_data_dictionary
+
+
+async def api_with_post(api: str, query: dict, body: bytes) -> dict:
+    """
+    Same as flask_main_cli.api_with_post()
+    :param api:<base>/<model name>/change
+    """
+    try:
+        patient_data_dict = json.loads(body)
+    except ValueError:
+        raise HTTPError(400, "The request body is not a json object.")
+    verify_data(patient_data_dict, api)
+    print(patient_data_dict)
+    patient_data_dict["predict_value"] = return_model_result(patient_data_dict, api)
+    return patient_data_dict
+
+
+def _route(method: str, path: str):
+    """
+    :return: (the api function, model name), or raise HTTPError if the path is not one of the apis
+    """
+    parts = path.strip('/').split('/')
+    if len(parts) == 1 and parts[0] != '' and method == 'GET':
+        return api_with_id, parts[0]
+    if len(parts) == 2 and parts[1] == 'change' and method == 'POST':
+        return api_with_post, parts[0]
+    if len(parts) in (1, 2) and parts[0] != '':
+        raise HTTPError(405, "The method is not allowed for the requested URL.")
+    raise HTTPError(404, "The requested URL was not found on the server.")
+
+
+async def _read_body(receive) -> bytes:
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def _send_json(send, status: int, data, extra_headers=None):
+    body = json.dumps(to_json(data), sort_keys=True, default=str).encode()
+    headers = [(b'content-type', b'application/json'),
+               (b'content-length', str(len(body)).encode()),
+               # 與flask_cors的預設相同, 允許所有來源
+               (b'access-control-allow-origin', b'*')]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers + (extra_headers or [])})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        return
+
+    method = scope['method']
+    if method == 'OPTIONS':
+        # CORS preflight
+        await _send_json(send, 200, {}, [(b'access-control-allow-methods', b'GET, POST, OPTIONS'),
+                                         (b'access-control-allow-headers', b'*')])
+        return
+
+    # The same as request.values in Flask, the first value of each query parameter
+    query = {key: values[0] for key, values in parse_qs(scope.get('query_string', b'').decode()).items()}
+    body = await _read_body(receive)
+    try:
+        api_function, api = _route(method, scope['path'])
+        result = await api_function(api, query, body)
+    except HTTPError as e:
+        await _send_json(send, e.status, {'error': e.description})
+        return
+    except Exception as e:
+        traceback.print_exc()
+        await _send_json(send, 500, {'error': str(e)})
+        return
+    await _send_json(send, 200, result)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(app, port=5000)
@@ -0,0 +1,96 @@
+"""
+Point-in-time backfill for retrospective validation: the features of one patient at many default_times.
+
+The resources of the union window(the earliest default_time) are fetched once, each Observation feature keeps its
+resources as a series sorted by date, and the window of each default_time is sliced with binary search.
+The window is the same as the live searches(date >= default_time - data_alive_time, without an upper bound),
+so the results are the same as calling model_feature_search_with_patient_id() for each default_time.
+"""
+import bisect
+
+from base.exceptions import FeatureSearchError
+from base.searchesets_new import Observation
+from base.searchesets_new import get_patient_index
+from base.searchesets_new import _data_time_since
+from base.searchesets_new import _is_latest_only
+from base.searchesets_new import _get_data_with_search_type
+from base.bulk_export import _date_key
+from base.bulk_export import _is_after
+from base.bulk_export import _matches_code
+from base.bulk_export import _search_index
+from base.patient_data_search import _get_result_dict
+
+
+class FeatureSeries:
+    """
+    The resources of one Observation feature, sorted by -date as the searches return them.
+    """
+
+    def __init__(self, resources: list, code: str, component_indexes: dict = None):
+        """
+        :param component_indexes: the component indexes of the resources(_find_component()), shared by the series of
+                                  the same resources
+        """
+        self.code = code
+        self.resources = [resource for resource in resources if _matches_code(resource, code, component_indexes)]
+        # The date keys in ascending order for bisect, the resources are in descending order
+        self._keys = [_date_key(resource) for resource in reversed(self.resources)]
+        # Only sorted if the compared dates are in the same order as the sorted dates(effectivePeriod may not be)
+        self._is_sorted = all(self._keys[i] <= self._keys[i + 1] for i in range(len(self._keys) - 1))
+
+    def window(self, data_time_since: str) -> list:
+        """
+        :return: the resources with date >= data_time_since, sorted by -date
+        """
+        if not self._is_sorted:
+            return [resource for resource in self.resources if _is_after(resource, data_time_since)]
+        # key[:len(data_time_since)] >= data_time_since is the same as key >= data_time_since
+        return self.resources[:len(self._keys) - bisect.bisect_left(self._keys, data_time_since)]
+
+
+def _search_series(index: dict, series: dict, key: str, table: dict, default_time) -> dict:
+    if key not in series:
+        # Condition and Patient don't depend on the window
+        return _search_index(index, table, default_time)
+
+    data_time_since = _data_time_since(table, default_time)
+    results = series[key].window(data_time_since)
+    return Observation._window_result(results, table['code'], data_time_since, _is_latest_only(table))
+
+
+def model_feature_search_with_default_times(patient_id, table, default_times) -> list:
+    """
+    Search the model's features of the patient at every default_time, with one fetch of each resource type.
+    :param table: the model's feature table, the same as model_feature_search_with_patient_id()
+    :param default_times: list of datetime
+    :return: list with the same order as default_times, each is the same as model_feature_search_with_patient_id()
+             at that default_time, or FeatureSearchError
+    """
+    default_times = list(default_times)
+    if len(default_times) == 0:
+        return []
+
+    earliest_time = min(default_times)
+    observation_keys = [key for key in table if str(table[key]['type_of_data']).capitalize() == 'Observation']
+    data_time_since = min((_data_time_since(table[key], earliest_time) for key in observation_keys), default=None)
+    index = get_patient_index(patient_id, table, data_time_since)
+    component_indexes = dict()
+    series = {key: FeatureSeries(index['Observation'], table[key]['code'], component_indexes)
+              for key in observation_keys}
+
+    results = list()
+    for default_time in default_times:
+        data = dict()
+        errors = dict()
+        for key in table:
+            try:
+                data[key] = _get_data_with_search_type(
+                    table[key], _search_series(index, series, key, table[key], default_time), default_time)
+            except Exception as e:
+                errors[key] = e
+
+        if len(errors) != 0:
+            results.append(FeatureSearchError(errors))
+        else:
+            results.append(_get_result_dict(data, default_time))
+    return results
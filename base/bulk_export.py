@@ -0,0 +1,232 @@
+"""
+Offline mode for model training: build the features of a cohort from the NDJSON files of a FHIR Bulk Data $export
+(Patient, Observation, Condition), without searching the FHIR Server.
+
+The patients are split into shards by zlib.crc32 of their id, one shard for each process. Every process reads all the
+files, but only json.loads the lines of its own patients(the subject is found with a regex first), indexes them by
+subject and resource type, then answers the features in the same way as the live searches, so the output is the same
+as model_feature_search_with_patient_id().
+"""
+import os
+import re
+import json
+import glob
+import gzip
+import zlib
+import datetime
+
+from concurrent.futures import ProcessPoolExecutor
+from fhirpy.base.exceptions import ResourceNotFound
+from fhirpy.base.utils import AttrDict
+from base.exceptions import FeatureSearchError
+from base.searchesets_new import CLIENT
+from base.searchesets_new import Observation
+from base.searchesets_new import Condition
+from base.searchesets_new import Patient
+from base.searchesets_new import ResourceMgmt
+from base.searchesets_new import CODING_PATH
+from base.searchesets_new import RAW_RESOURCES
+from base.searchesets_new import fast_json
+from base.searchesets_new import _get_path
+from base.searchesets_new import _find_component
+from base.searchesets_new import _coding_matches
+from base.searchesets_new import _data_time_since
+from base.searchesets_new import _is_latest_only
+from base.searchesets_new import _get_data_with_search_type
+from base.patient_data_search import _get_result_dict
+
+RESOURCE_TYPES = ('Patient', 'Observation', 'Condition')
+
+_RESOURCE_TYPE_REGEX = re.compile(r'"resourceType"\s*:\s*"(\w+)"')
+_SUBJECT_REGEX = re.compile(r'"subject"\s*:\s*\{[^{}]*?"reference"\s*:\s*"(?:Patient/)?([^"]+)"')
+_ID_REGEX = re.compile(r'"id"\s*:\s*"([^"]+)"')
+
+
+def _shard_of(patient_id: str, shards: int) -> int:
+    return zlib.crc32(patient_id.encode()) % shards
+
+
+def _open_ndjson(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def _ndjson_paths(paths) -> list:
+    """
+    :param paths: a directory of the $export output, or a list of NDJSON(.ndjson or .ndjson.gz) files
+    """
+    if isinstance(paths, str):
+        if os.path.isdir(paths):
+            return sorted(glob.glob(os.path.join(paths, '*.ndjson')) + glob.glob(os.path.join(paths, '*.ndjson.gz')))
+        return [paths]
+    return list(paths)
+
+
+def _line_patient_id(line: str, resource_type: str) -> str or None:
+    if resource_type == 'Patient':
+        # Patient的id在最外層，只找第一個巢狀object之前的部分，找不到才整行parse
+        nested = line.find('{', 1)
+        matched = _ID_REGEX.search(line, 0, nested if nested != -1 else len(line))
+        return matched.group(1) if matched else json.loads(line).get('id')
+
+    matched = _SUBJECT_REGEX.search(line)
+    if matched:
+        return matched.group(1)
+    reference = (json.loads(line).get('subject') or {}).get('reference')
+    return None if reference is None else str(reference).split('/')[-1]
+
+
+def _effective_date(resource) -> str:
+    if 'effectiveDateTime' in resource:
+        return resource['effectiveDateTime']
+    return (resource.get('effectivePeriod') or {}).get('start', '')
+
+
+def _date_key(resource) -> str:
+    # The date compared by _is_after()
+    if 'effectiveDateTime' in resource:
+        return resource['effectiveDateTime']
+    end = (resource.get('effectivePeriod') or {}).get('end')
+    return '9999' if end is None else end
+
+
+def _is_after(resource, data_time_since: str) -> bool:
+    # The same as date=ge<data_time_since>, a period is matched if it ends after data_time_since or has no end
+    return _date_key(resource)[:len(data_time_since)] >= data_time_since
+
+
+def _matches_code(resource, code: str, component_indexes: dict = None) -> bool:
+    # The same as combo-code, the code is in Observation.code or in one of the components
+    return _coding_matches(_get_path(resource, CODING_PATH), code) or \
+        _find_component(resource, code, component_indexes) is not None
+
+
+def _load_shard(paths: list, shard: int, shards: int, codes: set, patient_ids: set or None) -> dict:
+    """
+    Read the lines of the shard's patients into {patient id: {resource type: [SyncFHIRResource or dict]}}
+    The Observation and Condition lines without any of the codes are skipped before they are parsed.
+    """
+    index = dict()
+    for path in paths:
+        with _open_ndjson(path) as ndjson_file:
+            for line in ndjson_file:
+                line = line.strip()
+                if line == '':
+                    continue
+                matched = _RESOURCE_TYPE_REGEX.search(line)
+                resource_type = matched.group(1) if matched else None
+                if resource_type not in RESOURCE_TYPES:
+                    continue
+                if resource_type != 'Patient' and not any('"{}"'.format(code) in line for code in codes):
+                    continue
+
+                patient_id = _line_patient_id(line, resource_type)
+                if patient_id is None or _shard_of(patient_id, shards) != shard or \
+                        (patient_ids is not None and patient_id not in patient_ids):
+                    continue
+
+                if RAW_RESOURCES:
+                    resource = fast_json.loads(line)
+                else:
+                    resource = CLIENT.resource(resource_type, **json.loads(line, object_hook=AttrDict))
+                index.setdefault(patient_id, {key: [] for key in RESOURCE_TYPES})[resource_type].append(resource)
+
+    for resources in index.values():
+        # The same order as the searches: Observation by -date, Condition by recorded-date
+        resources['Observation'].sort(key=_effective_date, reverse=True)
+        resources['Condition'].sort(key=lambda resource: resource.get('recordedDate', ''))
+    return index
+
+
+def _search_index(patient_resources: dict, table: dict, default_time: datetime.datetime,
+                  component_indexes: dict = None) -> dict:
+    """
+    Return the same dict as the strategies' search(), from the patient's indexed resources
+    :param component_indexes: the component indexes of the patient's resources(_find_component()), shared by the
+                              features of the patient
+    """
+    type_of_data = str(table['type_of_data']).capitalize()
+    code = table['code']
+    if type_of_data == 'Observation':
+        data_time_since = _data_time_since(table, default_time)
+        results = [resource for resource in patient_resources['Observation']
+                   if _is_after(resource, data_time_since) and _matches_code(resource, code, component_indexes)]
+        return Observation._window_result(results, code, data_time_since, _is_latest_only(table))
+    elif type_of_data == 'Condition':
+        return Condition._condition_result(
+            [resource for resource in patient_resources['Condition'] if _coding_matches(_get_path(resource, CODING_PATH), code)])
+    elif type_of_data == 'Patient':
+        if len(patient_resources['Patient']) == 0:
+            raise ResourceNotFound('No resources found')
+        return Patient._patient_result(ResourceMgmt(Patient), patient_resources['Patient'][0], table, default_time)
+    raise AttributeError("'{}' type_of_data is not supported now, check it again.".format(table['type_of_data']))
+
+
+def _search_shard(paths: list, shard: int, shards: int, table: dict, default_time: datetime.datetime,
+                  patient_ids: set or None) -> dict:
+    codes = {token.rpartition('|')[2] for feature in table.values() for token in str(feature['code']).split(',')}
+    index = _load_shard(paths, shard, shards, codes, patient_ids)
+    if patient_ids is not None:
+        shard_patient_ids = [patient_id for patient_id in patient_ids if _shard_of(patient_id, shards) == shard]
+    else:
+        shard_patient_ids = list(index)
+
+    empty_resources = {key: [] for key in RESOURCE_TYPES}
+    results = dict()
+    for patient_id in shard_patient_ids:
+        data = dict()
+        errors = dict()
+        component_indexes = dict()
+        for key in table:
+            try:
+                data[key] = _get_data_with_search_type(table[key], _search_index(
+                    index.get(patient_id, empty_resources), table[key], default_time, component_indexes), default_time)
+            except Exception as e:
+                errors[key] = e
+
+        if len(errors) != 0:
+            results[patient_id] = FeatureSearchError(errors)
+        else:
+            results[patient_id] = _get_result_dict(data, default_time)
+    return results
+
+
+def model_feature_search_with_ndjson(paths, table, patient_ids=None, default_time=None, processes=None) -> dict:
+    """
+    Build the model's features of every patient in the $export NDJSON files, using all the cores.
+    :param paths: a directory of the $export output, or a list of NDJSON(.ndjson or .ndjson.gz) files
+    :param table: the model's feature table, the same as model_feature_search_with_patient_id()
+    :param patient_ids: only build these patients, default is every patient in the files
+    :param default_time: the time of the default, for model training used. DEFAULT=datetime.now()
+    :param processes: number of processes(and shards), DEFAULT=os.cpu_count()
+    :return: {patient id: the same as model_feature_search_with_patient_id(), or FeatureSearchError of the patient}
+    """
+    if default_time is None:
+        default_time = datetime.datetime.now()
+    paths = _ndjson_paths(paths)
+    shards = processes or os.cpu_count() or 1
+    patient_ids = None if patient_ids is None else set(patient_ids)
+
+    results = dict()
+    if shards == 1:
+        results.update(_search_shard(paths, 0, 1, table, default_time, patient_ids))
+        return results
+
+    with ProcessPoolExecutor(max_workers=shards) as executor:
+        futures = [executor.submit(_search_shard, paths, shard, shards, table, default_time, patient_ids)
+                   for shard in range(shards)]
+        for future in futures:
+            results.update(future.result())
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    from base import feature_table
+
+    # python -m base.bulk_export <$export output directory> <model name>
+    features__table = feature_table.FeatureTable("./config/features.csv")
+    for patient__id, result in model_feature_search_with_ndjson(
+            sys.argv[1], features__table.get_model_feature_dict(sys.argv[2])).items():
+        print(patient__id, result)
@@ -0,0 +1,185 @@
+import os
+import time
+import sqlite3
+import threading
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class CacheBackend(ABC):
+    """
+    The interface of the caches, every backend expires the entries after ttl seconds
+    and evicts the least recently used entries when there are more than maxsize entries.
+    """
+
+    @abstractmethod
+    def get(self, key, default=None):
+        pass
+
+    @abstractmethod
+    def set(self, key, value) -> None:
+        pass
+
+    @abstractmethod
+    def delete(self, key) -> None:
+        pass
+
+    @abstractmethod
+    def clear(self) -> None:
+        pass
+
+    @abstractmethod
+    def stats(self) -> dict:
+        pass
+
+
+class TTLCache(CacheBackend):
+    """
+    A thread-safe in-process cache.
+    Entries expire after ttl seconds, and the least recently used entry is evicted when the cache is full.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value, expire_time = self._data.get(key, (_MISSING, 0))
+            if value is _MISSING or expire_time <= time.monotonic():
+                if value is not _MISSING:
+                    del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests != 0 else 0.0,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+            }
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteTTLCache(CacheBackend):
+    """
+    An on-disk cache in a SQLite file, so every worker process on the same host shares the same entries.
+    Only str values are supported. The hit and miss counters are counted by each process.
+    """
+
+    def __init__(self, path: str, maxsize: int = 1024, ttl: float = 3600):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+
+        if os.path.dirname(path) != '':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expire_time REAL NOT NULL,
+                access_time REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS cache_access_time ON cache (access_time);
+        """)
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections could not be shared between threads, so each thread opens its own connection
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key, default=None):
+        now = time.time()
+        connection = self._connection()
+        row = connection.execute("SELECT value, expire_time FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] <= now:
+            if row is not None:
+                connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self.misses += 1
+            return default
+
+        connection.execute("UPDATE cache SET access_time = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return row[0]
+
+    def set(self, key, value: str) -> None:
+        now = time.time()
+        connection = self._connection()
+        connection.execute("INSERT OR REPLACE INTO cache (key, value, expire_time, access_time) VALUES (?, ?, ?, ?)",
+                           (key, value, now + self.ttl, now))
+        size = connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if size > self.maxsize:
+            connection.execute("DELETE FROM cache WHERE expire_time <= ?", (now,))
+            connection.execute("DELETE FROM cache WHERE key IN "
+                               "(SELECT key FROM cache ORDER BY access_time LIMIT max(0, "
+                               "(SELECT COUNT(*) FROM cache) - ?))", (self.maxsize,))
+
+    def delete(self, key) -> None:
+        self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self) -> None:
+        self._connection().execute("DELETE FROM cache")
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests != 0 else 0.0,
+            "size": self._connection().execute("SELECT COUNT(*) FROM cache").fetchone()[0],
+            "maxsize": self.maxsize,
+        }
+
+
+def create_cache(backend: str, maxsize: int = 1024, ttl: float = 3600, path: str = None) -> CacheBackend or None:
+    """
+    :param backend: "memory", "sqlite" or "none"
+    """
+    backend = str(backend).lower()
+    if backend == "memory":
+        return TTLCache(maxsize=maxsize, ttl=ttl)
+    elif backend == "sqlite":
+        return SQLiteTTLCache(path, maxsize=maxsize, ttl=ttl)
+    elif backend == "none":
+        return None
+    raise AttributeError("'{}' cache backend is not supported now, check it again.".format(backend))
@@ -8,3 +8,14 @@ class FeatureCodeIsEmpty(BaseFHIRError):
 
 class TypeUnknown(BaseFHIRError):
     pass
+
+
+class FeatureSearchError(BaseFHIRError):
+    def __init__(self, errors: dict):
+        # errors: {feature name: the exception raised while searching the feature}
+        self.errors = errors
+        super().__init__("; ".join("{}: {!r}".format(feature, error) for feature, error in errors.items()))
+
+    def __reduce__(self):
+        # Keep the errors dict when the error is sent back from another process
+        return self.__class__, (self.errors,)
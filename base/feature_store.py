@@ -0,0 +1,464 @@
+"""
+Local columnar feature store for historical extraction, saved as Parquet files in a directory.
+
+Each row is one coding of a resource: (patient, resource type, resource id, system, code, component,
+effective time, value), filled from FHIR searches or $export NDJSON files. The reads push the patient, code and time
+predicates down to the Parquet files, so a patient's feature reads only the row groups it needs.
+
+- FeatureStore.search() returns the same dict as the strategies' search(), so get_patient_resources(store=...)
+  gives the same result as the FHIR Server.
+- FeatureStore.materialize() builds the features of the whole cohort with one scan, the Observation features are
+  computed with vectorized pandas operations instead of one search for each patient and feature.
+
+pyarrow is only needed by this module, it is imported when the store is used.
+"""
+import os
+import json
+import uuid
+import datetime
+
+from fhirpy.base.exceptions import ResourceNotFound
+from fhirpy.base.utils import AttrDict
+from base.exceptions import FeatureSearchError
+from base.searchesets_new import CLIENT
+from base.searchesets_new import Observation
+from base.searchesets_new import Condition
+from base.searchesets_new import Patient
+from base.searchesets_new import ResourceMgmt
+from base.searchesets_new import RAW_RESOURCES
+from base.searchesets_new import get_patient_index
+from base.searchesets_new import _subject_id
+from base.searchesets_new import _data_time_since
+from base.searchesets_new import _is_latest_only
+from base.searchesets_new import _is_window_summary
+from base.searchesets_new import _resource_not_found
+from base.searchesets_new import _get_data_with_search_type
+from base.bulk_export import _date_key
+from base.bulk_export import _effective_date
+from base.bulk_export import _ndjson_paths
+from base.bulk_export import _open_ndjson
+from base.datetime_normalizer import normalize_datetimes
+from base.records import FeatureValue
+from base.patient_data_search import _get_result_dict
+
+RESOURCE_TYPES = ('Patient', 'Observation', 'Condition')
+# effective: effectiveDateTime or effectivePeriod.start(recordedDate, birthDate), for sorting and the output date
+# date_key: the date compared with date=ge, the same as bulk_export._date_key()
+# position: the order of the coding in the resource, the first matched component is used as the value
+COLUMNS = ('patient', 'resource_type', 'resource_id', 'system', 'code', 'component', 'effective', 'effective_end',
+           'is_period', 'date_key', 'value_number', 'value_string', 'value_type', 'position')
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("The feature store needs pyarrow, install it with 'pip install pyarrow'")
+    return pyarrow
+
+
+def _schema():
+    pa = _import_pyarrow()
+    return pa.schema([
+        ('patient', pa.string()), ('resource_type', pa.string()), ('resource_id', pa.string()),
+        ('system', pa.string()), ('code', pa.string()), ('component', pa.bool_()),
+        ('effective', pa.string()), ('effective_end', pa.string()), ('is_period', pa.bool_()),
+        ('date_key', pa.string()), ('value_number', pa.float64()), ('value_string', pa.string()),
+        ('value_type', pa.string()), ('position', pa.int32())
+    ])
+
+
+def _value_columns(value) -> dict:
+    if isinstance(value, bool):
+        return {'value_number': float(value), 'value_string': None, 'value_type': 'boolean'}
+    if isinstance(value, int):
+        return {'value_number': float(value), 'value_string': None, 'value_type': 'integer'}
+    if isinstance(value, float):
+        return {'value_number': value, 'value_string': None, 'value_type': 'decimal'}
+    if isinstance(value, str):
+        return {'value_number': None, 'value_string': value, 'value_type': 'string'}
+    return {'value_number': None, 'value_string': None, 'value_type': None}
+
+
+def _resource_rows(resource) -> list:
+    """
+    Split a Patient, Observation or Condition resource into the rows of the store, one row for each coding
+    """
+    rows = _resource_codings(resource)
+    for position, row in enumerate(rows):
+        row['position'] = position
+    return rows
+
+
+def _resource_codings(resource) -> list:
+    resource_type = resource['resourceType']
+    base_row = {'resource_type': resource_type, 'resource_id': resource.get('id'), 'effective_end': None,
+                'is_period': False, 'component': False}
+    if resource_type == 'Patient':
+        return [dict(base_row, patient=resource.get('id'), system=None, code=None,
+                     effective=resource.get('birthDate'), date_key=resource.get('birthDate'),
+                     **_value_columns(None))]
+
+    base_row['patient'] = _subject_id(resource)
+    if resource_type == 'Condition':
+        base_row['effective'] = base_row['date_key'] = resource.get('recordedDate')
+        return [dict(base_row, system=coding.get('system'), code=coding.get('code'), **_value_columns(None))
+                for coding in (resource.get('code') or {}).get('coding', [])]
+
+    base_row['effective'] = _effective_date(resource) or None
+    base_row['date_key'] = _date_key(resource)
+    if 'effectivePeriod' in resource and 'effectiveDateTime' not in resource:
+        base_row['is_period'] = True
+        base_row['effective_end'] = resource['effectivePeriod'].get('end')
+
+    if 'valueQuantity' in resource:
+        value = resource['valueQuantity'].get('value')
+    else:
+        value = resource.get('valueString')
+    rows = [dict(base_row, system=coding.get('system'), code=coding.get('code'), **_value_columns(value))
+            for coding in (resource.get('code') or {}).get('coding', [])]
+    for component in resource.get('component', []):
+        component_value = (component.get('valueQuantity') or {}).get('value')
+        rows.extend(dict(base_row, system=coding.get('system'), code=coding.get('code'), component=True,
+                         **_value_columns(component_value))
+                    for coding in (component.get('code') or {}).get('coding', []))
+    return rows
+
+
+def _code_tokens(code: str) -> list:
+    # "system|code,code" -> [("system", "code"), ("", "code")]
+    return [(token.rpartition('|')[0], token.rpartition('|')[2]) for token in str(code).split(',')]
+
+
+def _matches_code_mask(frame, code: str):
+    """
+    The vectorized _coding_matches(): the rows with one of the code tokens, the system is only compared if it is given
+    """
+    mask = None
+    for system, token_code in _code_tokens(code):
+        token_mask = frame['code'] == token_code
+        if system != '':
+            token_mask &= frame['system'] == system
+        mask = token_mask if mask is None else mask | token_mask
+    return mask
+
+
+def _row_value(row):
+    if row['value_type'] == 'integer':
+        return int(row['value_number'])
+    if row['value_type'] == 'decimal':
+        return float(row['value_number'])
+    if row['value_type'] == 'boolean':
+        return bool(row['value_number'])
+    return row['value_string']
+
+
+def _as_resource(resource_type: str, data: dict):
+    if RAW_RESOURCES:
+        return data
+    return CLIENT.resource(resource_type, **json.loads(json.dumps(data), object_hook=AttrDict))
+
+
+def _rows_to_resources(frame) -> list:
+    """
+    Rebuild the resources(with the stored codings only) from the rows, in the order of the rows
+    """
+    resources = dict()
+    for row in frame.to_dict('records'):
+        key = (row['resource_type'], row['resource_id'])
+        if key not in resources:
+            data = {'resourceType': row['resource_type'], 'id': row['resource_id']}
+            if row['resource_type'] == 'Patient':
+                data['birthDate'] = row['effective']
+            else:
+                data['subject'] = {'reference': 'Patient/{}'.format(row['patient'])}
+                data['code'] = {'coding': []}
+                if row['resource_type'] == 'Condition':
+                    data['recordedDate'] = row['effective']
+                elif row['is_period']:
+                    data['effectivePeriod'] = {key: value for key, value in (
+                        ('start', row['effective']), ('end', row['effective_end'])) if value is not None}
+                elif row['effective'] is not None:
+                    data['effectiveDateTime'] = row['effective']
+            resources[key] = data
+        data = resources[key]
+        if row['resource_type'] == 'Patient':
+            continue
+
+        coding = {key: row[key] for key in ('system', 'code') if row[key] is not None}
+        if row['component']:
+            component = {'code': {'coding': [coding]}}
+            if row['value_type'] is not None:
+                component['valueQuantity'] = {'value': _row_value(row)}
+            data.setdefault('component', []).append(component)
+        else:
+            data['code']['coding'].append(coding)
+            if row['value_type'] == 'string':
+                data['valueString'] = row['value_string']
+            elif row['value_type'] is not None:
+                data['valueQuantity'] = {'value': _row_value(row)}
+    return [_as_resource(key[0], data) for key, data in resources.items()]
+
+
+class FeatureStore:
+    def __init__(self, path: str):
+        """
+        :param path: the directory of the Parquet files, it is created if not exists
+        """
+        self.path = path
+        self._rows = list()
+        os.makedirs(path, exist_ok=True)
+
+    def add_resources(self, resources):
+        """
+        Add Patient, Observation or Condition resources(fhirpy resources or dicts), they are written by flush()
+        """
+        for resource in resources:
+            if resource.get('resourceType') in RESOURCE_TYPES:
+                self._rows.extend(_resource_rows(resource))
+
+    def add_ndjson(self, paths):
+        """
+        Add the resources of the $export NDJSON files, then flush them.
+        :param paths: a directory of the $export output, or a list of NDJSON(.ndjson or .ndjson.gz) files
+        """
+        for path in _ndjson_paths(paths):
+            with _open_ndjson(path) as ndjson_file:
+                self.add_resources(json.loads(line) for line in ndjson_file if line.strip() != '')
+            self.flush()
+
+    def fill_from_server(self, patient_ids, table, default_time=None):
+        """
+        Search the model's features of the patients from the FHIR Server(the same windows as the live searches
+        at default_time), and add the resources into the store.
+        """
+        if default_time is None:
+            default_time = datetime.datetime.now()
+        data_time_since = min((_data_time_since(feature, default_time) for feature in table.values()
+                               if str(feature['type_of_data']).capitalize() == 'Observation'), default=None)
+        for patient_id in patient_ids:
+            index = get_patient_index(patient_id, table, data_time_since)
+            for resource_type in RESOURCE_TYPES:
+                self.add_resources(index[resource_type])
+        self.flush()
+
+    def flush(self):
+        """
+        Write the added rows into a new Parquet file, sorted by patient, code and date so that the row groups'
+        statistics could skip the other patients and times
+        """
+        if len(self._rows) == 0:
+            return
+        pa = _import_pyarrow()
+        table = pa.Table.from_pylist(self._rows, schema=_schema()).sort_by(
+            [('patient', 'ascending'), ('resource_type', 'ascending'), ('code', 'ascending'),
+             ('date_key', 'descending')])
+        pa.parquet.write_table(table, os.path.join(self.path, 'part-{}.parquet'.format(uuid.uuid4().hex)),
+                               row_group_size=64 * 1024)
+        self._rows = list()
+
+    def read(self, patient_ids=None, codes=None, since: str = None, resource_types=None):
+        """
+        Read the rows with the predicates pushed down to the Parquet files.
+        :param patient_ids: only these patients
+        :param codes: only the rows with these feature codes("system|code,code"), the Patient rows are always read
+        :param since: only the rows with date_key >= since(the Condition and Patient rows are always read)
+        :param resource_types: only these resource types
+        :return: pandas.DataFrame, sorted as the searches(date descending), the duplicated rows are removed
+        """
+        pa = _import_pyarrow()
+        field = pa.dataset.field
+        files = [os.path.join(self.path, name) for name in sorted(os.listdir(self.path)) if name.endswith('.parquet')]
+        if len(files) == 0:
+            return _schema().empty_table().to_pandas()
+
+        predicate = None
+
+        def _and(expression):
+            return expression if predicate is None else predicate & expression
+
+        if patient_ids is not None:
+            predicate = _and(field('patient').isin(list(patient_ids)))
+        if resource_types is not None:
+            predicate = _and(field('resource_type').isin(list(resource_types)))
+        if codes is not None:
+            token_codes = sorted({token_code for code in codes for _, token_code in _code_tokens(code)})
+            predicate = _and(field('code').isin(token_codes) | (field('resource_type') == 'Patient'))
+        if since is not None:
+            predicate = _and((field('date_key') >= since) | (field('resource_type') != 'Observation'))
+
+        dataset = pa.dataset.dataset(files, schema=_schema(), format='parquet')
+        frame = dataset.to_table(filter=predicate).to_pandas()
+        frame = frame.astype(object).where(frame.notna(), None).drop_duplicates()
+        # 與search的排序相同: 最新的在前面, 相同時間保持加入的順序
+        return frame.sort_values(['effective', 'position'], ascending=[False, True], kind='mergesort',
+                                 na_position='last').reset_index(drop=True)
+
+    def search(self, patient_id: str, table: dict, default_time: datetime.datetime) -> dict:
+        """
+        The same as the strategies' search(), but the resources are read from the store
+        """
+        type_of_data = str(table['type_of_data']).capitalize()
+        code = table['code']
+        if type_of_data == 'Observation':
+            data_time_since = _data_time_since(table, default_time)
+            frame = self.read([patient_id], [code], data_time_since, ['Observation'])
+            results = _rows_to_resources(frame[_matches_code_mask(frame, code)])
+            return Observation._window_result(results, code, data_time_since, _is_latest_only(table))
+        elif type_of_data == 'Condition':
+            frame = self.read([patient_id], [code], None, ['Condition'])
+            return _condition_result(frame[_matches_code_mask(frame, code)])
+        elif type_of_data == 'Patient':
+            return _patient_result(self.read([patient_id], None, None, ['Patient']), table, default_time)
+        raise AttributeError("'{}' type_of_data is not supported now, check it again.".format(table['type_of_data']))
+
+    def materialize(self, table, default_time=None, patient_ids=None) -> dict:
+        """
+        Build the model's features of the cohort with one scan of the store.
+        :param table: the model's feature table, the same as model_feature_search_with_patient_id()
+        :param patient_ids: only these patients, default is every patient in the store
+        :return: {patient id: the same as model_feature_search_with_patient_id(), or FeatureSearchError of the patient}
+        """
+        if default_time is None:
+            default_time = datetime.datetime.now()
+        data_time_since = min((_data_time_since(feature, default_time) for feature in table.values()
+                               if str(feature['type_of_data']).capitalize() == 'Observation'), default=None)
+        frame = self.read(patient_ids, [feature['code'] for feature in table.values()], data_time_since)
+        if patient_ids is None:
+            patient_ids = list(dict.fromkeys(frame['patient']))
+
+        features = dict()
+        for key, feature in table.items():
+            type_of_data = str(feature['type_of_data']).capitalize()
+            if type_of_data == 'Observation' and not _is_window_summary(feature):
+                features[key] = _materialize_observation(frame, feature, default_time)
+            else:
+                features[key] = _materialize_by_patient(frame, feature, default_time, type_of_data)
+
+        results = dict()
+        for patient_id in patient_ids:
+            data = dict()
+            errors = dict()
+            for key, feature in table.items():
+                result = features[key].get(patient_id)
+                if result is None:
+                    result = _missing_result(feature, default_time)
+                if isinstance(result, Exception):
+                    errors[key] = result
+                else:
+                    data[key] = result
+            results[patient_id] = FeatureSearchError(errors) if len(errors) != 0 else data
+        return results
+
+
+def _condition_result(frame) -> dict:
+    # The Conditions are sorted by recorded-date(ascending) in the searches
+    frame = frame.sort_values(['effective', 'position'], kind='mergesort', na_position='last')
+    results = _rows_to_resources(frame)
+    return Condition._condition_result(results)
+
+
+def _patient_result(frame, table: dict, default_time: datetime.datetime) -> dict:
+    patients = _rows_to_resources(frame)
+    if len(patients) == 0:
+        raise ResourceNotFound('No resources found')
+    return Patient._patient_result(ResourceMgmt(Patient), patients[0], table, default_time)
+
+
+def _missing_result(table: dict, default_time: datetime.datetime):
+    """
+    The result of the feature for a patient without any rows of the feature
+    """
+    type_of_data = str(table['type_of_data']).capitalize()
+    if type_of_data == 'Observation':
+        return _resource_not_found(table['code'], _data_time_since(table, default_time))
+    if type_of_data == 'Patient':
+        return ResourceNotFound('No resources found')
+    return _get_result_dict({'feature': _get_data_with_search_type(
+        table, Condition._condition_result([]))}, default_time)['feature']
+
+
+def _materialize_by_patient(frame, table: dict, default_time: datetime.datetime, type_of_data: str) -> dict:
+    """
+    Condition and Patient features have few rows, they are computed from the rebuilt resources of each patient.
+    The window summaries of Observation(mean, slope, ...) are computed by their search types in the same way.
+    """
+    if type_of_data == 'Condition':
+        rows = frame[(frame['resource_type'] == 'Condition') & _matches_code_mask(frame, table['code'])]
+    elif type_of_data == 'Observation':
+        data_time_since = _data_time_since(table, default_time)
+        rows = frame[(frame['resource_type'] == 'Observation') & frame['date_key'].notna()]
+        rows = rows[(rows['date_key'] >= data_time_since) & _matches_code_mask(rows, table['code'])]
+    else:
+        rows = frame[frame['resource_type'] == 'Patient']
+
+    results = dict()
+    for patient_id, patient_rows in rows.groupby('patient', sort=False):
+        try:
+            if type_of_data == 'Condition':
+                data = _condition_result(patient_rows)
+            elif type_of_data == 'Observation':
+                data = Observation._window_result(_rows_to_resources(patient_rows), table['code'], data_time_since)
+            else:
+                data = _patient_result(patient_rows, table, default_time)
+            results[patient_id] = _get_result_dict(
+                {'feature': _get_data_with_search_type(table, data, default_time)}, default_time)['feature']
+        except Exception as e:
+            results[patient_id] = e
+    return results
+
+
+def _materialize_observation(frame, table: dict, default_time: datetime.datetime) -> dict:
+    """
+    The vectorized Observation.search() + GetLatest/GetMax/GetMin + get_datetime/get_value for all the patients,
+    the window summaries are computed by _materialize_by_patient().
+    The frame is sorted by date descending, so the first row of each group is the newest one.
+    """
+    data_time_since = _data_time_since(table, default_time)
+    code = table['code']
+    search_type = str(table['search_type']).capitalize()
+    rows = frame[(frame['resource_type'] == 'Observation') & frame['date_key'].notna()]
+    rows = rows[(rows['date_key'] >= data_time_since) & _matches_code_mask(rows, code)].copy()
+    if search_type not in ('Latest', 'Max', 'Min'):
+        raise AttributeError("'{}' search_type is not supported now, check it again.".format(table['search_type']))
+
+    # 每個resource是用Observation.code符合的還是只有component符合
+    rows['is_code'] = ~rows['component'].astype(bool)
+    rows['resource_is_code'] = rows.groupby(['patient', 'resource_id'], sort=False)['is_code'].transform('max')
+    # 病患只要有resource是用code符合的就使用code，否則使用component(與Observation.search()先搜尋code相同)
+    rows['patient_is_code'] = rows.groupby('patient', sort=False)['resource_is_code'].transform('max')
+    rows = rows[rows['resource_is_code'] == rows['patient_is_code']]
+    # 用code符合的resource取code的數值，否則取第一個符合的component的數值
+    rows = rows[rows['is_code'] == rows['patient_is_code']].drop_duplicates(['patient', 'resource_id'])
+
+    if search_type == 'Latest':
+        selected = rows.drop_duplicates('patient')
+    else:
+        numbers = rows[rows['value_type'].isin(['integer', 'decimal'])]
+        numbers = numbers.assign(value_number=numbers['value_number'].astype(float))
+        grouped = numbers.groupby('patient', sort=False)['value_number']
+        selected = numbers.loc[grouped.idxmax() if search_type == 'Max' else grouped.idxmin()]
+
+    results = dict()
+    for row, date in zip(selected.to_dict('records'), normalize_datetimes(selected['effective'])):
+        results[row['patient']] = FeatureValue(date, _row_value(row))
+    for patient_id in set(rows['patient']) - set(results):
+        results[patient_id] = Exception("No data inside the data list.")
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    from base import feature_table
+
+    # python -m base.feature_store <store directory> <$export output directory> <model name>
+    store = FeatureStore(sys.argv[1])
+    if len(sys.argv) > 3:
+        store.add_ndjson(sys.argv[2])
+    model_table = feature_table.FeatureTable("./config/features.csv").get_model_feature_dict(sys.argv[-1])
+    start_time = time.time()
+    cohort = store.materialize(model_table)
+    print("{} patients in {:.2f}s".format(len(cohort), time.time() - start_time))
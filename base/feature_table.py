@@ -1,12 +1,110 @@
 import csv
 import re
+import os
+import threading
 
+from collections.abc import Mapping
+from dateutil.relativedelta import relativedelta
 from base.exceptions import FeatureCodeIsEmpty
+from base.searchesets_new import RESOURCE_MGMTS
+from base.searchesets_new import ResourcesInterface
+from base.searchesets_new import _get_func_mgmt
+from base.searchesets_new import _is_window_summary
 
 
 class FeatureTable:
     def __init__(self, feature_table_position):
-        self.table = self._create_table(feature_table_position)
+        self.feature_table_position = feature_table_position
+        self._file_stat = self._stat()
+        table = self._create_table(feature_table_position)
+        # 每個model只編譯一次，request只需要執行plan
+        # (table, plans) are swapped together by reload(), the requests keep the plans they got before
+        self._snapshot = (table, {model_name: ModelPlan(model_features)
+                                  for model_name, model_features in table.items()})
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def table(self) -> dict:
+        return self._snapshot[0]
+
+    @property
+    def plans(self) -> dict:
+        return self._snapshot[1]
+
+    def _stat(self) -> tuple:
+        file_stat = os.stat(self.feature_table_position)
+        return file_stat.st_mtime_ns, file_stat.st_size
+
+    def reload(self):
+        """
+        Parse and validate the feature table file again, then swap it in. If the file is not valid
+        (FeatureCodeIsEmpty, the format of data_alive_time, an unsupported type_of_data or search_type...),
+        the exception is raised and the current table is kept.
+        The plans of the models that are not changed are kept, so the states built on them(e.g. warm_state) stay valid.
+        """
+        file_stat = self._stat()
+        table = self._create_table(self.feature_table_position)
+        old_plans = self.plans
+        plans = dict()
+        for model_name, model_features in table.items():
+            plan = ModelPlan(model_features)
+            self._check_plan(model_name, plan)
+            plans[model_name] = old_plans[model_name] if old_plans.get(model_name) == plan else plan
+        self._snapshot = (table, plans)
+        self._file_stat = file_stat
+
+    @staticmethod
+    def _check_plan(model_name: str, plan):
+        """
+        The table loaded at the start raises the unsupported type_of_data or search_type when the feature is searched,
+        a reloaded table is rejected before it replaces a working one.
+        """
+        for feature, table in plan.items():
+            if table.resource_mgmt is None or not issubclass(table.resource_mgmt.strategy, ResourcesInterface):
+                raise AttributeError("'{}' type_of_data of {}/{} is not supported now, check it again.".format(
+                    table['type_of_data'], model_name, feature))
+            if str(table['search_type']) != '' and table.get_func_mgmt is None:
+                raise AttributeError("'{}' search_type of {}/{} is not supported now, check it again.".format(
+                    table['search_type'], model_name, feature))
+
+    def start_watching(self, interval: float = 5):
+        """
+        Start a background thread that checks the mtime and size of the file every interval seconds,
+        and reloads the table after the file is changed and not changing anymore(the same in two checks).
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._watch, args=(interval,), name='feature-table-watcher',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop_watching(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _watch(self, interval: float):
+        last_stat = self._file_stat
+        failed_stat = None
+        while not self._stop_event.wait(interval):
+            try:
+                file_stat = self._stat()
+            except OSError as e:
+                # 檔案可能正在被取代，等下一次
+                print("Feature table is not readable: {!r}".format(e))
+                continue
+
+            # 寫入中的檔案還在變化，等到兩次檢查都相同才重新載入; 載入失敗的版本不再重試
+            if file_stat != self._file_stat and file_stat == last_stat and file_stat != failed_stat:
+                try:
+                    self.reload()
+                    print("Feature table reloaded: {}".format(self.feature_table_position))
+                except Exception as e:
+                    failed_stat = file_stat
+                    print("Feature table reload failed, the current table is kept: {!r}".format(e))
+            last_stat = file_stat
 
     @classmethod
     def _create_table(cls, feature_table_position):
@@ -48,10 +146,99 @@ class FeatureTable:
             return table
 
     def get_model_feature_dict(self, model_name):
-        if model_name not in self.table:
+        """
+        :return: ModelPlan of the model, read the same as {feature name: feature's table}
+        """
+        # The plans of one snapshot, reload() may swap it between the two lookups
+        plans = self._snapshot[1]
+        if model_name not in plans:
             raise KeyError("Model is not exist in the feature table.")
 
-        return self.table[model_name]
+        return plans[model_name]
+
+
+def plan_feature_searches(table) -> tuple:
+    """
+    Group the features that could be searched together: 'latest' Observations with the same data_alive_time
+    are fetched with one multi-code search, and the window summaries(mean, count, first, slope, percentile) of the
+    same code and data_alive_time share one search and one WindowArrays. The other features are searched one by one.
+    The other Observation search types (max, min) walk through their window page by page, so they are not grouped.
+    :return: tuple of feature name tuples, each tuple is one search
+    """
+    groups = dict()
+    plan = list()
+    for key in table:
+        if str(table[key]['type_of_data']).lower() != 'observation':
+            plan.append([key])
+            continue
+        if str(table[key]['search_type']).lower() == 'latest':
+            group_key = ('latest', table[key]['data_alive_time'])
+        elif _is_window_summary(table[key]):
+            group_key = ('window', table[key]['code'], table[key]['data_alive_time'])
+        else:
+            plan.append([key])
+            continue
+        if group_key not in groups:
+            groups[group_key] = list()
+            plan.append(groups[group_key])
+        groups[group_key].append(key)
+    return tuple(tuple(features) for features in plan)
+
+
+class FeaturePlan(Mapping):
+    """
+    The compiled feature: read the same as the feature's table dict({'code', 'type_of_data', 'search_type', ...}),
+    with the strategies bound once(resource_mgmt, get_func_mgmt). The window of data_alive_time is precomputed by
+    DataAliveTime.get_relativedelta().
+    """
+    __slots__ = ('_table', 'resource_mgmt', 'get_func_mgmt')
+
+    def __init__(self, table: dict):
+        self._table = dict(table)
+        # 不支援的type_of_data或search_type在執行時才報錯，與之前相同
+        self.resource_mgmt = RESOURCE_MGMTS.get(str(table['type_of_data']).capitalize())
+        self.get_func_mgmt = _get_func_mgmt(str(table['search_type']).capitalize())
+
+    def __getitem__(self, key):
+        return self._table[key]
+
+    def __iter__(self):
+        return iter(self._table)
+
+    def __len__(self):
+        return len(self._table)
+
+    def __repr__(self):
+        return repr(self._table)
+
+
+class ModelPlan(Mapping):
+    """
+    The compiled model: read the same as {feature name: feature's table}, the features are FeaturePlan,
+    with the grouped searches(plan_feature_searches()) and the codes of each resource type joined with ","
+    """
+    __slots__ = ('_features', 'searches', 'codes')
+
+    def __init__(self, model_features: dict):
+        self._features = {key: FeaturePlan(table) for key, table in model_features.items()}
+        self.searches = plan_feature_searches(self._features)
+        codes = dict()
+        for table in self._features.values():
+            if table['code'] != '':
+                codes.setdefault(str(table['type_of_data']).capitalize(), list()).append(table['code'])
+        self.codes = {resource_type: ",".join(type_codes) for resource_type, type_codes in codes.items()}
+
+    def __getitem__(self, key):
+        return self._features[key]
+
+    def __iter__(self):
+        return iter(self._features)
+
+    def __len__(self):
+        return len(self._features)
+
+    def __repr__(self):
+        return repr(self._features)
 
 
 class DataAliveTime:
@@ -63,6 +250,8 @@ class DataAliveTime:
         self._minutes = 0
         self._seconds = 0
         self.__set_data_alive_time(data_alive_time)
+        self._relativedelta = relativedelta(years=self._years, months=self._months, days=self._days,
+                                            hours=self._hours, minutes=self._minutes, seconds=self._seconds)
 
     def __set_data_alive_time(self, data_alive_time):
         time_prog = re.compile(
@@ -80,6 +269,15 @@ class DataAliveTime:
             raise ValueError(
                 "Time Format is incorrect, " + data_alive_time)
 
+    def __eq__(self, other):
+        return isinstance(other, DataAliveTime) and self._as_tuple() == other._as_tuple()
+
+    def __hash__(self):
+        return hash(self._as_tuple())
+
+    def _as_tuple(self):
+        return self._years, self._months, self._days, self._hours, self._minutes, self._seconds
+
     def get_years(self):
         return self._years
 
@@ -98,6 +296,9 @@ class DataAliveTime:
     def get_seconds(self):
         return self._seconds
 
+    def get_relativedelta(self):
+        return self._relativedelta
+
 
 if __name__ == '__main__':
     from exceptions import FeatureCodeIsEmpty
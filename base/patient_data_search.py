@@ -1,23 +1,246 @@
+import asyncio
 import datetime
+import weakref
+import threading
+import contextvars
+import configparser
 
+from concurrent.futures import ThreadPoolExecutor
+from base.exceptions import FeatureSearchError
+from base.searchesets_new import CLIENT
 from base.searchesets_new import get_patient_resources
+from base.searchesets_new import get_grouped_patient_resources
+from base.searchesets_new import get_patients_resources
+from base.searchesets_new import get_patient_searches
+from base.searchesets_new import async_get_patient_resources
+from base.searchesets_new import async_get_grouped_patient_resources
+from base.searchesets_new import prefetch_searches_with_batch
+from base.searchesets_new import PREFETCHED_BUNDLES
 from base.searchesets_new import get_resource_datetime_and_value
+from base.records import FeatureValue
+from base.feature_table import plan_feature_searches
 
+config = configparser.ConfigParser()
+config.read("./config.ini")
+MAX_WORKERS = config.getint('fhir_server', 'MAX_WORKERS', fallback=8)
+MAX_REQUESTS_PER_SERVER = config.getint('fhir_server', 'MAX_REQUESTS_PER_SERVER', fallback=8)
+ASYNC_MAX_REQUESTS_PER_SERVER = config.getint('fhir_server', 'ASYNC_MAX_REQUESTS_PER_SERVER', fallback=256)
 
-def model_feature_search_with_patient_id(patient_id, table, default_time=None, data_alive_time=None):
+# 所有request共用同一個thread pool, 並且每個FHIR Server同時間只允許MAX_REQUESTS_PER_SERVER個search在進行
+_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='feature-search')
+_SERVER_SEMAPHORES = dict()
+_SERVER_SEMAPHORES_LOCK = threading.Lock()
+# asyncio.Semaphore belongs to the event loop that uses it, so the semaphores are kept for each loop
+_ASYNC_SERVER_SEMAPHORES = weakref.WeakKeyDictionary()
+# 不支援batch Bundle的FHIR Server, 之後就直接個別搜尋
+_BATCH_UNSUPPORTED_SERVERS = set()
+
+
+def _server_semaphore(server_url: str) -> threading.BoundedSemaphore:
+    with _SERVER_SEMAPHORES_LOCK:
+        if server_url not in _SERVER_SEMAPHORES:
+            _SERVER_SEMAPHORES[server_url] = threading.BoundedSemaphore(MAX_REQUESTS_PER_SERVER)
+        return _SERVER_SEMAPHORES[server_url]
+
+
+def _async_server_semaphore(server_url: str) -> asyncio.Semaphore:
+    semaphores = _ASYNC_SERVER_SEMAPHORES.setdefault(asyncio.get_running_loop(), dict())
+    if server_url not in semaphores:
+        semaphores[server_url] = asyncio.Semaphore(ASYNC_MAX_REQUESTS_PER_SERVER)
+    return semaphores[server_url]
+
+
+def _plan_feature_searches(table) -> tuple:
+    # The compiled feature_table.ModelPlan has its searches already
+    searches = getattr(table, 'searches', None)
+    return searches if searches is not None else plan_feature_searches(table)
+
+
+def _search_features(patient_id, table, features, default_time, data_alive_time=None) -> dict:
+    with _server_semaphore(CLIENT.url):
+        if len(features) == 1:
+            return {features[0]: get_patient_resources(patient_id, table[features[0]], default_time, data_alive_time)}
+        return get_grouped_patient_resources(
+            patient_id, {key: table[key] for key in features}, default_time, data_alive_time)
+
+
+def _search_patients_features(patient_ids, table, features, default_time, data_alive_time=None) -> dict:
+    with _server_semaphore(CLIENT.url):
+        return get_patients_resources(patient_ids, {key: table[key] for key in features}, default_time, data_alive_time)
+
+
+def _search_features_serial(patient_id, table, default_time, data_alive_time=None) -> dict:
+    data = dict()
+    for features in _plan_feature_searches(table):
+        data.update(_search_features(patient_id, table, features, default_time, data_alive_time))
+    return {key: data[key] for key in table}
+
+
+def _search_features_concurrent(patient_id, table, default_time, data_alive_time=None) -> dict:
+    """
+    Run every planned search on the shared thread pool, the wall time is close to the slowest search.
+    If any of the features failed, FeatureSearchError is raised after all the searches are done,
+    and the errors are kept with the feature that caused them.
+    """
+    futures = list()
+    for features in _plan_feature_searches(table):
+        # 每個search都用一份自己的context, 才看得到呼叫者設定的PREFETCHED_BUNDLES
+        futures.append((features, _EXECUTOR.submit(
+            contextvars.copy_context().run,
+            _search_features, patient_id, table, features, default_time, data_alive_time)))
+
+    data = dict()
+    errors = dict()
+    for features, future in futures:
+        try:
+            data.update(future.result())
+        except FeatureSearchError as e:
+            errors.update(e.errors)
+        except Exception as e:
+            for key in features:
+                errors[key] = e
+
+    if len(errors) != 0:
+        raise FeatureSearchError(errors)
+    return {key: data[key] for key in table}
+
+
+def _search_features_batch(patient_id, table, default_time, data_alive_time=None) -> dict:
+    """
+    Send the first search of every planned search in one FHIR batch Bundle, then run the planned searches
+    concurrently, they read their first page from the batch response instead of sending it again.
+    The following pages (max, min) are still fetched one by one.
+    If the server doesn't support batch, the searches are sent one by one, the same as "concurrent", and the server
+    is remembered. If the batch only failed this time(e.g. 503), only this call falls back.
+    """
+    plan = _plan_feature_searches(table)
+    prefetched = None
+    if CLIENT.url not in _BATCH_UNSUPPORTED_SERVERS:
+        searches = list()
+        for features in plan:
+            searches.extend(get_patient_searches(patient_id, {key: table[key] for key in features}, default_time,
+                                               data_alive_time))
+
+        if len(searches) != 0:
+            with _server_semaphore(CLIENT.url):
+                prefetched = prefetch_searches_with_batch(searches)
+            if prefetched is None:
+                _BATCH_UNSUPPORTED_SERVERS.add(CLIENT.url)
+
+    token = PREFETCHED_BUNDLES.set(prefetched)
+    try:
+        return _search_features_concurrent(patient_id, table, default_time, data_alive_time)
+    finally:
+        PREFETCHED_BUNDLES.reset(token)
+
+
+def model_feature_search_with_patient_id(patient_id, table, default_time=None, data_alive_time=None,
+                                         fetch_mode="serial"):
+    """
+    :param fetch_mode: "serial" searches the features one after another,
+                       "concurrent" searches all the features of the model at the same time,
+                       "batch" sends the searches of the model in one FHIR batch Bundle.
+    """
     if default_time is None:
         default_time = datetime.datetime.now()
 
+    if fetch_mode == "serial":
+        data = _search_features_serial(patient_id, table, default_time, data_alive_time)
+    elif fetch_mode == "concurrent":
+        data = _search_features_concurrent(patient_id, table, default_time, data_alive_time)
+    elif fetch_mode == "batch":
+        data = _search_features_batch(patient_id, table, default_time, data_alive_time)
+    else:
+        raise AttributeError("'{}' fetch_mode is not supported now, check it again.".format(fetch_mode))
+
+    return _get_result_dict(data, default_time)
+
+
+async def _async_search_features(patient_id, table, features, default_time, data_alive_time=None) -> dict:
+    async with _async_server_semaphore(CLIENT.url):
+        if len(features) == 1:
+            return {features[0]: await async_get_patient_resources(
+                patient_id, table[features[0]], default_time, data_alive_time)}
+        return await async_get_grouped_patient_resources(
+            patient_id, {key: table[key] for key in features}, default_time, data_alive_time)
+
+
+async def async_model_feature_search_with_patient_id(patient_id, table, default_time=None, data_alive_time=None):
+    """
+    Same as model_feature_search_with_patient_id() with "concurrent" fetch_mode, but the planned searches are
+    coroutines on the running event loop instead of threads, for the async serving mode.
+    """
+    if default_time is None:
+        default_time = datetime.datetime.now()
+
+    plan = _plan_feature_searches(table)
+    searched = await asyncio.gather(
+        *(_async_search_features(patient_id, table, features, default_time, data_alive_time) for features in plan),
+        return_exceptions=True)
+
     data = dict()
-    for key in table:
-        data[key] = dict()
-        data[key] = get_patient_resources(patient_id, table[key], default_time, data_alive_time)
+    errors = dict()
+    for features, result in zip(plan, searched):
+        if isinstance(result, FeatureSearchError):
+            errors.update(result.errors)
+        elif isinstance(result, Exception):
+            for key in features:
+                errors[key] = result
+        else:
+            data.update(result)
+
+    if len(errors) != 0:
+        raise FeatureSearchError(errors)
+    return _get_result_dict({key: data[key] for key in table}, default_time)
+
+
+def model_feature_search_with_patient_ids(patient_ids, table, default_time=None, data_alive_time=None) -> dict:
+    """
+    Search the model's features of many patients together. Each planned search is sent once for all the patients
+    (subject=id1,id2,..., chunked by the url length), so the number of FHIR searches grows with
+    features x chunks instead of features x patients.
+    :return: {patient id: the same as model_feature_search_with_patient_id(), or FeatureSearchError of the patient}
+    """
+    if default_time is None:
+        default_time = datetime.datetime.now()
+    patient_ids = list(dict.fromkeys(patient_ids))
+
+    futures = list()
+    for features in _plan_feature_searches(table):
+        futures.append((features, _EXECUTOR.submit(
+            _search_patients_features, patient_ids, table, features, default_time, data_alive_time)))
+
+    data = {patient_id: dict() for patient_id in patient_ids}
+    errors = {patient_id: dict() for patient_id in patient_ids}
+    for features, future in futures:
+        try:
+            features_data = future.result()
+        except Exception as e:
+            for patient_id in patient_ids:
+                for key in features:
+                    errors[patient_id][key] = e
+            continue
+
+        for patient_id in patient_ids:
+            for key in features:
+                if isinstance(features_data[patient_id][key], Exception):
+                    errors[patient_id][key] = features_data[patient_id][key]
+                else:
+                    data[patient_id][key] = features_data[patient_id][key]
+
+    results = dict()
+    for patient_id in patient_ids:
+        if len(errors[patient_id]) != 0:
+            results[patient_id] = FeatureSearchError(errors[patient_id])
+        else:
+            results[patient_id] = _get_result_dict({key: data[patient_id][key] for key in table}, default_time)
+    return results
+
 
+def _get_result_dict(data, default_time) -> dict:
     result_dict = dict()
     for data_key in data:
-        result_dict[data_key] = dict()
-        result_dict[data_key]['date'], result_dict[data_key]['value'] = get_resource_datetime_and_value(
-            data[data_key], default_time)
+        result_dict[data_key] = FeatureValue(*get_resource_datetime_and_value(data[data_key], default_time))
 
     return result_dict
 
@@ -0,0 +1,153 @@
+"""
+The records passed between the searches, the search types and the apis, instead of a new dict for each one:
+
+- FeatureData: the resources of a feature found by the strategies' search(), {'resource', 'component_code', 'type'}
+- FeatureValue: the resolved date and value of a feature, {'date', 'value'}
+- TimeSeries: the value of a 'series' feature, the timestamps and the values of the window as numpy arrays
+
+Both use __slots__, so a record has no __dict__ and takes about a third of the memory of the same dict. They could be
+read and changed by key like the dicts before(e.g. patient_data_dict['spo2']['value'] in the models), and
+to_json() converts them back to dicts for the json responses.
+"""
+
+
+class _SlotsRecord:
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __eq__(self, other):
+        if isinstance(other, (_SlotsRecord, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def keys(self):
+        return self.__slots__
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.__slots__]
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def to_dict(self) -> dict:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class FeatureData(_SlotsRecord):
+    __slots__ = ('resource', 'component_code', 'type', 'component_indexes')
+
+    def __init__(self, resource, component_code: str or None, type: str, component_indexes: dict = None):
+        """
+        :param resource: iterable of the resources, the resource chosen by the search type, or the value(Patient age)
+        :param component_code: the code of the feature if it's found in Observation.component, otherwise None
+        :param type: 'Observation', 'Condition' or 'Patient'
+        :param component_indexes: the component indexes of the fetch that found the resources(see _find_component() in
+                                  searchesets_new), so reading the values doesn't index the resources again.
+                                  None if the resources are not indexed.
+        """
+        self.resource = resource
+        self.component_code = component_code
+        self.type = type
+        self.component_indexes = component_indexes
+
+
+class FeatureValue(_SlotsRecord):
+    __slots__ = ('date', 'value')
+
+    def __init__(self, date: str or None, value):
+        self.date = date
+        self.value = value
+
+
+class TimeSeries(_SlotsRecord):
+    __slots__ = ('times', 'values', 'interval')
+
+    def __init__(self, times, values, interval: int or None = None):
+        """
+        :param times: contiguous numpy datetime64[m] array, ascending
+        :param values: contiguous numpy float64 array of the same length, NaN for the empty bins of the grid
+        :param interval: minutes between the timestamps if it's resampled onto a regular grid, otherwise None
+        """
+        self.times = times
+        self.values = values
+        self.interval = interval
+
+    def __eq__(self, other):
+        if isinstance(other, TimeSeries):
+            return self.to_json() == other.to_json()
+        return NotImplemented
+
+    def __len__(self):
+        return len(self.values)
+
+    def to_json(self) -> dict:
+        """
+        The arrays are encoded as two plain lists instead of a dict for each point, NaN is null.
+        A regular grid is only its start and interval(minutes), the timestamps are start + i * interval.
+        """
+        values = [None if value != value else value for value in self.values.tolist()]
+        if self.interval is not None:
+            start = str(self.times[0]) if len(self.times) != 0 else None
+            return {'start': start, 'interval': self.interval, 'values': values}
+        return {'times': self.times.astype(str).tolist(), 'values': values}
+
+
+def to_json(data):
+    """
+    Convert the records in the data(nested in dicts and lists) into dicts, for jsonify() and json.dumps()
+    """
+    if isinstance(data, TimeSeries):
+        return data.to_json()
+    if isinstance(data, _SlotsRecord):
+        return {key: to_json(value) for key, value in data.items()}
+    if isinstance(data, dict):
+        return {key: to_json(value) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [to_json(value) for value in data]
+    return data
+
+
+if __name__ == '__main__':
+    import tracemalloc
+
+    # python -m base.records
+    # The results of one patient's backfill: features x default_times of {'date', 'value'},
+    # and the FeatureData of every feature before the values are resolved
+    features = 20
+    default_times = 2000
+
+    def measure(build) -> int:
+        tracemalloc.start()
+        data = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del data
+        return size
+
+    dict_size = measure(lambda: [
+        ({'feature_{}'.format(i): {'date': '2021-10-18T09:49', 'value': i} for i in range(features)},
+         [{'resource': None, 'component_code': None, 'type': 'Observation'} for _ in range(features)])
+        for _ in range(default_times)])
+    record_size = measure(lambda: [
+        ({'feature_{}'.format(i): FeatureValue('2021-10-18T09:49', i) for i in range(features)},
+         [FeatureData(None, None, 'Observation') for _ in range(features)])
+        for _ in range(default_times)])
+    print("{} features x {} default_times".format(features, default_times))
+    print("dicts:   {:10,d} bytes".format(dict_size))
+    print("records: {:10,d} bytes, {:.0%} of the dicts".format(record_size, record_size / dict_size))
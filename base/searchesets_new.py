@@ -1,35 +1,100 @@
 from __future__ import annotations
 import re
+import copy
+import json
+import asyncio
+import functools
+import aiohttp
+import operator
+import itertools
+import contextvars
 import configparser
+import requests
+import numpy
 
 from abc import ABC, abstractmethod
 from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 from fhirpy import SyncFHIRClient
+from fhirpy import AsyncFHIRClient
 from fhirpy.lib import SyncFHIRResource
 from fhirpy.base.searchset import datetime
 from fhirpy.base.searchset import FHIR_DATE_FORMAT
 from fhirpy.base.exceptions import ResourceNotFound
-from dateutil.relativedelta import relativedelta
+from fhirpy.base.exceptions import OperationOutcome
+from fhirpy.base.exceptions import InvalidResponse
+from fhirpy.base.utils import AttrDict, encode_params, get_by_path, parse_pagination_url
+from base.exceptions import FeatureSearchError
+from base.cache import TTLCache
+from base.cache import create_cache
+from base.datetime_normalizer import normalize_datetime
+from base.records import FeatureData
+from base.records import FeatureValue
+from base.records import TimeSeries
+
+try:
+    import ujson as fast_json
+except ImportError:
+    fast_json = json
+
+
+class _AsyncFHIRClient(AsyncFHIRClient):
+    def _build_request_headers(self):
+        # requests skips the headers with None value(e.g. no Authorization), but aiohttp can't send them
+        return {key: value for key, value in super()._build_request_headers().items() if value is not None}
+
 
 config = configparser.ConfigParser()
 config.read("./config.ini")
 CLIENT = SyncFHIRClient(config['fhir_server']['FHIR_SERVER_URL'])
+# The same server for the async serving mode, the searches are built with CLIENT and sent with ASYNC_CLIENT
+ASYNC_CLIENT = _AsyncFHIRClient(config['fhir_server']['FHIR_SERVER_URL'])
+MAX_URL_LENGTH = config.getint('fhir_server', 'MAX_URL_LENGTH', fallback=2048)
+MAX_LATEST_PAGE_SIZE = 1000
+# The component-code search of a feature is sent on this pool at the same time as its code search
+_COMPONENT_SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=config.getint('fhir_server', 'MAX_WORKERS', fallback=8),
+                                                thread_name_prefix='component-search')
+# {prefetch key: bundle} of the searches answered by a batch Bundle, set by the caller for the current context
+PREFETCHED_BUNDLES = contextvars.ContextVar('PREFETCHED_BUNDLES', default=None)
+PATIENT_CACHE = TTLCache(maxsize=config.getint('cache', 'PATIENT_CACHE_SIZE', fallback=1024),
+                         ttl=config.getfloat('cache', 'PATIENT_CACHE_TTL', fallback=86400))
+# Cache of the raw search bundles, only the bundle JSON is stored, never the converted results
+SEARCH_CACHE = create_cache(config.get('cache', 'SEARCH_CACHE_BACKEND', fallback='none'),
+                            maxsize=config.getint('cache', 'SEARCH_CACHE_SIZE', fallback=4096),
+                            ttl=config.getfloat('cache', 'SEARCH_CACHE_TTL', fallback=60),
+                            path=config.get('cache', 'SEARCH_CACHE_PATH', fallback='./cache/search_cache.sqlite3'))
+# The bundles are decoded by fast_json into plain dicts, without AttrDict and SyncFHIRResource of every entry
+RAW_RESOURCES = config.getboolean('fhir_server', 'RAW_RESOURCES', fallback=False)
 
 
 # FHIR_DATE_FORMAT='%Y-%m-%d'
+# The Observation elements needed by the searches(subject and code to split the bundle), get_datetime() and get_value()
+OBSERVATION_ELEMENTS = ('subject', 'code', 'component', 'effectiveDateTime', 'effectivePeriod', 'valueQuantity',
+                        'valueString')
+# The paths read by the strategies' get_datetime() and get_value(), the same for SyncFHIRResource and the raw dicts
+CODING_PATH = ('code', 'coding')
+EFFECTIVE_DATE_TIME_PATH = ('effectiveDateTime',)
+EFFECTIVE_PERIOD_START_PATH = ('effectivePeriod', 'start')
+VALUE_QUANTITY_PATH = ('valueQuantity', 'value')
+VALUE_STRING_PATH = ('valueString',)
+RECORDED_DATE_PATH = ('recordedDate',)
+
 
 class GetFuncMgmt:
     """
     The Context defines the interface of interest to clients.
     """
 
-    def __init__(self, strategy: GetFuncInterface = None) -> None:
+    def __init__(self, strategy: GetFuncInterface = None, parameter=None) -> None:
         """
         First, the Context accepts a strategy through the constructor, but
         also provides a setter to change it at runtime.
+        @param parameter: the parameter of the search type, e.g. 90 of 'percentile90'
         """
 
         self._strategy = strategy
+        self.parameter = parameter
 
     @property
     def strategy(self) -> GetFuncInterface:
@@ -80,22 +145,49 @@ class GetMax(GetFuncInterface):
     def execute(self, data: dict) -> dict:
         """
         For Observation used only, Return the maximum SyncFHIRResources
-        @todo: Complete the code.
-        @param data:
-        @return:
+        @param data: dict, {"resource": iterable of SyncFHIRResources, "component_code": None or str,
+                      "type": "Observation"}
+        @return: dict, the same as data but the resource is the maximum SyncFHIRResources
         """
-        pass
+        return _get_extreme_resource(self, data, operator.gt)
 
 
 class GetMin(GetFuncInterface):
     def execute(self, data: dict) -> dict:
         """
         For Observation used only, Return the minimum SyncFHIRResources
-        @todo: Complete the code.
-        @param data:
-        @return:
+        @param data: dict, {"resource": iterable of SyncFHIRResources, "component_code": None or str,
+                      "type": "Observation"}
+        @return: dict, the same as data but the resource is the minimum SyncFHIRResources
         """
-        pass
+        return _get_extreme_resource(self, data, operator.lt)
+
+
+def _get_extreme_resource(context: GetFuncMgmt, data: dict, is_better) -> dict:
+    """
+    Walk through the resources once and keep only the current extreme one, so the resources could be
+    a generator that reads the bundle page by page, and the memory usage doesn't grow with the window.
+    The value is read in the same way as Observation.get_value(), resources without a number value are skipped,
+    also the ones without any value(e.g. with dataAbsentReason instead of valueQuantity).
+    The resources are sorted by -date, so the newest one is kept when the values are the same.
+    """
+    extreme_resource = None
+    extreme_value = None
+    for resource in data['resource']:
+        try:
+            value = Observation.get_value(context, FeatureData(resource, data['component_code'], 'Observation',
+                                                               data.get('component_indexes')))
+        except KeyError:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        if extreme_value is None or is_better(value, extreme_value):
+            extreme_resource, extreme_value = resource, value
+
+    if extreme_resource is None:
+        raise Exception("No data inside the data list.")
+    data['resource'] = extreme_resource
+    return data
 
 
 class GetLatest(GetFuncInterface):
@@ -124,6 +216,224 @@ class GetLatest(GetFuncInterface):
         return data
 
 
+class WindowArrays:
+    """
+    The values and the timestamps of an Observation feature's window, loaded into numpy arrays once.
+    The summaries of the same code and data_alive_time(e.g. mean, slope and percentile90 of the heart rate) get the
+    same WindowArrays from Observation.search_group(), so the window is read and converted only once for all of them.
+    The resources are sorted by -date as the searches, the values without a number(or without any value) are NaN.
+    """
+
+    def __init__(self, data: dict, data_time_since: str = None, default_time: datetime = None):
+        """
+        @param data: dict, {"resource": iterable of SyncFHIRResources, "component_code": None or str,
+                     "type": "Observation"}
+        @param data_time_since: the start of the searched window(FHIR_DATE_FORMAT), with default_time as its end.
+                                None if the window is not known, it's from the oldest to the newest resource.
+        """
+        self._resources = data['resource']
+        self.component_code = data['component_code']
+        self._component_indexes = data.get('component_indexes')
+        self._window = None
+        if data_time_since is not None and default_time is not None:
+            # 與resources相同，都是不帶時區的wall-clock時間
+            self._window = (numpy.datetime64(data_time_since).astype('datetime64[m]'),
+                            numpy.datetime64(default_time.strftime('%Y-%m-%dT%H:%M')))
+        self._values = None
+        self._times = None
+        self._oldest_resource = None
+        self._count = 0
+
+    def _load(self):
+        if self._values is not None:
+            return
+        values = list()
+        times = list()
+        for resource in self._resources:
+            feature_data = FeatureData(resource, self.component_code, 'Observation', self._component_indexes)
+            try:
+                value = Observation.get_value(self, feature_data)
+            except KeyError:
+                # 沒有數值的resource(如dataAbsentReason)也是NaN
+                value = None
+            values.append(numpy.nan if isinstance(value, bool) or not isinstance(value, (int, float)) else value)
+            times.append(Observation.get_datetime(self, feature_data, None))
+            self._oldest_resource = resource
+        self._count = len(values)
+        self._values = numpy.array(values, dtype=float)
+        self._times = numpy.array(times, dtype='datetime64[m]')
+        # 只讀一次，之後就不需要resources了
+        self._resources = None
+        self._component_indexes = None
+
+    @property
+    def count(self) -> int:
+        self._load()
+        return self._count
+
+    @property
+    def oldest_resource(self):
+        self._load()
+        return self._oldest_resource
+
+    @property
+    def newest_time(self) -> str or None:
+        self._load()
+        if self._count == 0 or numpy.isnat(self._times[0]):
+            return None
+        return str(self._times[0])
+
+    def numbers(self) -> numpy.ndarray:
+        """
+        @return: the number values, raise the same Exception as GetMax and GetMin if there is no number
+        """
+        self._load()
+        numbers = self._values[~numpy.isnan(self._values)]
+        if len(numbers) == 0:
+            raise Exception("No data inside the data list.")
+        return numbers
+
+    def timed_numbers(self) -> tuple:
+        """
+        @return: (hours since the oldest timestamp, values) of the numbers with a timestamp
+        """
+        self._load()
+        mask = ~numpy.isnan(self._values) & ~numpy.isnat(self._times)
+        times = self._times[mask]
+        if len(times) == 0:
+            raise Exception("No data inside the data list.")
+        return (times - times.min()) / numpy.timedelta64(1, 'h'), self._values[mask]
+
+    def series(self, interval: int = None, fill: bool = False) -> TimeSeries:
+        """
+        The number values with a timestamp as a TimeSeries, ascending by time
+        @param interval: resample onto a grid of every interval minutes(aligned to the multiples of interval since
+                         1970-01-01T00:00), the value of a bin is the newest value in it. None is not resampled.
+                         The grid covers the whole window(data_time_since to default_time) if it's known, so the
+                         series of every patient has the same length, the values out of the window are dropped.
+        @param fill: forward-fill the empty bins of the grid with the bin before, otherwise they are NaN.
+                     The empty bins before the first value are still NaN.
+        """
+        self._load()
+        mask = ~numpy.isnan(self._values) & ~numpy.isnat(self._times)
+        if not mask.any():
+            raise Exception("No data inside the data list.")
+        # The window is sorted by -date, reverse it and keep the order of the same timestamps
+        times = self._times[mask][::-1]
+        values = self._values[mask][::-1]
+        order = numpy.argsort(times, kind='stable')
+        times = times[order]
+        values = values[order]
+        if interval is None:
+            return TimeSeries(times, values)
+
+        bins = times.astype('int64') // interval
+        if self._window is not None:
+            first_bin, last_bin = (bound.astype('int64') // interval for bound in self._window)
+            inside = (bins >= first_bin) & (bins <= last_bin)
+            bins = bins[inside]
+            values = values[inside]
+        else:
+            first_bin, last_bin = bins[0], bins[-1]
+        # 每個bin最後(最新)的一筆
+        is_last = numpy.append(bins[1:] != bins[:-1], True)[:len(bins)]
+        grid = numpy.full(last_bin - first_bin + 1, numpy.nan)
+        grid[bins[is_last] - first_bin] = values[is_last]
+        if fill:
+            # 空的bin拿前面最近一個有數值的bin，第一個有數值的bin之前的仍然是NaN
+            positions = numpy.where(numpy.isnan(grid), 0, numpy.arange(len(grid)))
+            grid = grid[numpy.maximum.accumulate(positions)]
+        grid_times = ((first_bin + numpy.arange(len(grid))) * interval).astype('datetime64[m]')
+        return TimeSeries(grid_times, grid, interval)
+
+
+def _window_arrays(data: dict) -> WindowArrays:
+    # Observation.search_group() gives the shared WindowArrays of the group, otherwise load the resources here
+    if isinstance(data['resource'], WindowArrays):
+        return data['resource']
+    return WindowArrays(data)
+
+
+def _aggregate_result(window: WindowArrays, value) -> dict:
+    """
+    The summary of the window is dated by the newest resource of the window
+    """
+    return FeatureData(FeatureValue(window.newest_time, value), None, 'Aggregate')
+
+
+class GetMean(GetFuncInterface):
+    def execute(self, data: dict) -> dict:
+        """
+        For Observation used only, Return the mean of the number values in the window
+        @param data: dict, {"resource": iterable of SyncFHIRResources or WindowArrays, "component_code": None or str,
+                      "type": "Observation"}
+        @return: dict, {"resource": {"date", "value"}, "component_code": None, "type": "Aggregate"}
+        """
+        window = _window_arrays(data)
+        return _aggregate_result(window, float(window.numbers().mean()))
+
+
+class GetCount(GetFuncInterface):
+    def execute(self, data: dict) -> dict:
+        """
+        For Observation used only, Return the number of the resources in the window(with or without a number value)
+        @return: dict, {"resource": {"date", "value"}, "component_code": None, "type": "Aggregate"}
+        """
+        window = _window_arrays(data)
+        return _aggregate_result(window, window.count)
+
+
+class GetFirst(GetFuncInterface):
+    def execute(self, data: dict) -> dict:
+        """
+        For Observation used only, Return the oldest SyncFHIRResources in the window
+        @return: dict, the same as data but the resource is the oldest SyncFHIRResources
+        """
+        window = _window_arrays(data)
+        if window.oldest_resource is None:
+            raise Exception("No data inside the data list.")
+        return FeatureData(window.oldest_resource, window.component_code, 'Observation')
+
+
+class GetSlope(GetFuncInterface):
+    def execute(self, data: dict) -> dict:
+        """
+        For Observation used only, Return the least squares slope of the number values over time, value per hour.
+        At least two different timestamps are needed.
+        @return: dict, {"resource": {"date", "value"}, "component_code": None, "type": "Aggregate"}
+        """
+        window = _window_arrays(data)
+        hours, values = window.timed_numbers()
+        hours = hours - hours.mean()
+        denominator = float((hours * hours).sum())
+        if denominator == 0:
+            raise Exception("Not enough data to compute the slope, at least two different times are needed.")
+        return _aggregate_result(window, float((hours * (values - values.mean())).sum()) / denominator)
+
+
+class GetPercentile(GetFuncInterface):
+    def execute(self, data: dict) -> dict:
+        """
+        For Observation used only, Return the percentile(linear interpolation) of the number values in the window,
+        the percentile is the parameter of the GetFuncMgmt, e.g. 90 of 'percentile90'
+        @return: dict, {"resource": {"date", "value"}, "component_code": None, "type": "Aggregate"}
+        """
+        window = _window_arrays(data)
+        return _aggregate_result(window, float(numpy.percentile(window.numbers(), self.parameter)))
+
+
+class GetSeries(GetFuncInterface):
+    def execute(self, data: dict) -> dict:
+        """
+        For Observation used only, Return the number values of the window as a TimeSeries, the parameter of the
+        GetFuncMgmt is (interval minutes or None, forward-fill), e.g. (60, True) of 'series_1h_ffill'
+        @return: dict, {"resource": {"date", "value": TimeSeries}, "component_code": None, "type": "Aggregate"}
+        """
+        interval, fill = self.parameter or (None, False)
+        window = _window_arrays(data)
+        return _aggregate_result(window, window.series(interval, fill))
+
+
 class ResourceMgmt:
     """
     The Context defines the interface of interest to clients.
@@ -170,6 +480,50 @@ class ResourceMgmt:
         resource_list = self._strategy.search(self, patient_id, table, default_time, data_alive_time)
         return resource_list
 
+    async def async_get_data_with_resources(self, patient_id: str,
+                                            table: Dict, default_time: datetime, data_alive_time=None) -> Dict:
+        if self._strategy is None:
+            raise AttributeError("Strategy was not set yet. Set the strategy with 'foo.strategy = bar()'")
+
+        print("Getting patient's data asynchronously with the {} method".format(self._strategy.__name__))
+        resource_list = await self._strategy.async_search(self, patient_id, table, default_time, data_alive_time)
+        return resource_list
+
+    async def async_get_grouped_data_with_resources(self, patient_id: str, tables: Dict[str, Dict],
+                                                    default_time: datetime, data_alive_time=None) -> Dict[str, Dict]:
+        if self._strategy is None:
+            raise AttributeError("Strategy was not set yet. Set the strategy with 'foo.strategy = bar()'")
+
+        print("Getting patient's grouped data asynchronously with the {} method".format(self._strategy.__name__))
+        resource_lists = await self._strategy.async_search_group(
+            self, patient_id, tables, default_time, data_alive_time)
+        return resource_lists
+
+    def get_grouped_data_with_resources(self, patient_id: str, tables: Dict[str, Dict],
+                                        default_time: datetime, data_alive_time=None) -> Dict[str, Dict]:
+        if self._strategy is None:
+            raise AttributeError("Strategy was not set yet. Set the strategy with 'foo.strategy = bar()'")
+
+        print("Getting patient's grouped data with the {} method".format(self._strategy.__name__))
+        resource_lists = self._strategy.search_group(self, patient_id, tables, default_time, data_alive_time)
+        return resource_lists
+
+    def get_patients_data_with_resources(self, patient_ids: list, tables: Dict[str, Dict],
+                                         default_time: datetime, data_alive_time=None) -> Dict[str, Dict[str, Dict]]:
+        if self._strategy is None:
+            raise AttributeError("Strategy was not set yet. Set the strategy with 'foo.strategy = bar()'")
+
+        print("Getting patients' data with the {} method".format(self._strategy.__name__))
+        resource_lists = self._strategy.search_patients(self, patient_ids, tables, default_time, data_alive_time)
+        return resource_lists
+
+    def get_search_with_resources(self, patient_id: str, tables: Dict[str, Dict], default_time: datetime,
+                                  data_alive_time=None):
+        if self._strategy is None:
+            raise AttributeError("Strategy was not set yet. Set the strategy with 'foo.strategy = bar()'")
+
+        return self._strategy.build_search(self, patient_id, tables, default_time, data_alive_time)
+
     def get_datetime_with_resources(self, data_dictionary: Dict, default_time: datetime):
         if self._strategy is None:
             raise AttributeError("Strategy was not set yet. Set the strategy with 'foo.strategy = bar()'")
@@ -234,94 +588,827 @@ def _return_date_time_formatter(datetime_string: str) -> str or None:
         This is a function that returns a standard DateTime format
         While using it, make sure the datetime_string parameter is at datetime string
     """
+    return normalize_datetime(datetime_string)
 
-    date_regex = '([0-9]([0-9]([0-9][1-9]|[1-9]0)|[1-9]00)|[1-9]000)(-(0[1-9]|1[0-2])(-(0[1-9]|[1-2][0-9]|3[0-1])))'
-    date_time_without_sec_regex = '([0-9]([0-9]([0-9][1-9]|[1-9]0)|[1-9]00)|[1-9]000)(-(0[1-9]|1[0-2])(-(0[1-9]|[' \
-                                  '1-2][0-9]|3[0-1])(T([01][0-9]|2[0-3]):[0-5][0-9]))) '
-    if type(datetime_string) == str:
-        if re.search(date_time_without_sec_regex, datetime_string):
-            return datetime_string[:16]
-        elif re.search(date_regex, datetime_string):
-            return datetime_string[:10] + 'T00:00'
 
-    return None
+def _get_path(resource, path: tuple):
+    # KeyError if any of the keys is missing, the same as the attribute access of SyncFHIRResource
+    for key in path:
+        resource = resource[key]
+    return resource
+
+
+def _coding_matches(codings: list, code: str) -> bool:
+    """
+    Check if any of the codings matches the feature's code,
+    the code could be "code", "system|code" or several of them joined with ","
+    """
+    for system, token_code in _code_tokens(code):
+        for coding in codings:
+            if coding.get('code') == token_code and (system == '' or coding.get('system') == system):
+                return True
+    return False
+
+
+@functools.lru_cache(maxsize=1024)
+def _code_tokens(code: str) -> tuple:
+    # "code,system|code" -> (('', 'code'), ('system', 'code'))
+    return tuple((system, token_code) for system, _, token_code in
+                 (token.rpartition('|') for token in code.split(',')))
+
+
+def _build_component_index(resource) -> dict:
+    """
+    {(system, code): position of the first component with the coding}, also {('', code): position} for the codes
+    without system
+    """
+    index = dict()
+    for position, component in enumerate(resource.get('component', [])):
+        for coding in _get_path(component, CODING_PATH):
+            index.setdefault((coding.get('system'), coding.get('code')), position)
+            index.setdefault(('', coding.get('code')), position)
+    return index
+
+
+def _find_component(resource, code: str, component_indexes: dict = None):
+    """
+    The first component of the resource with a coding matched the code(the same as _coding_matches()), or None.
+    @param component_indexes: {id(resource): (resource, component index)} owned by one fetch, the index is built once
+                              for each resource of the fetch and shared by all the features reading the resource,
+                              and it's freed with the fetch. None scans the components.
+    """
+    if component_indexes is None:
+        return next((component for component in resource.get('component', [])
+                     if _coding_matches(_get_path(component, CODING_PATH), code)), None)
+
+    entry = component_indexes.get(id(resource))
+    if entry is None:
+        # The resource is kept with its index, so its id is not reused while the dict is alive
+        entry = component_indexes[id(resource)] = (resource, _build_component_index(resource))
+
+    index = entry[1]
+    positions = [index[token] for token in _code_tokens(code) if token in index]
+    if len(positions) == 0:
+        return None
+    return resource['component'][min(positions)]
+
+
+def _canonical_params(search) -> str:
+    # fhirpy builds _elements from a set, so the elements are sorted to keep the params the same in every process
+    params = {key: value for key, value in search.params.items() if key != '_format'}
+    if '_elements' in params:
+        params['_elements'] = [",".join(sorted(elements.split(','))) for elements in params['_elements']]
+    return encode_params(dict(sorted(params.items())))
+
+
+def _search_cache_key(patient_id: str, resource_type: str, code: str, data_time_since: str or None, search) -> str:
+    # The search parameters are also in the key, so the latest search(_count=1) and the whole window are not mixed.
+    return json.dumps([patient_id, resource_type, code, data_time_since, _canonical_params(search)])
+
+
+def _prefetch_key(search) -> str:
+    return json.dumps([search.resource_type, _canonical_params(search)])
+
+
+# The statuses of the batch POST that mean the server doesn't support batch at all,
+# the other failures(5xx, a 4xx of one too large Bundle, connection errors) only fall back for the current call
+BATCH_UNSUPPORTED_STATUSES = frozenset((404, 405, 501))
+
+
+def prefetch_searches_with_batch(searches: list) -> dict or None:
+    """
+    Send the searches as one FHIR batch Bundle with GET entries, the server answers all of them in one HTTP exchange.
+    :param searches: list of SyncFHIRSearchSet
+    :return: {prefetch key: the searchset bundle of the entry} for the entries that succeeded,
+             an empty dict if the batch failed this time(the searches are sent one by one),
+             or None if the server doesn't support batch(404, 405, 501, or the reply isn't a batch-response Bundle)
+    """
+    bundle = {
+        'resourceType': 'Bundle',
+        'type': 'batch',
+        'entry': [{'request': {'method': 'GET',
+                               'url': '{}?{}'.format(search.resource_type, encode_params(search.params))}}
+                  for search in searches]
+    }
+    try:
+        # 直接送出request才拿得到status code, 與CLIENT._do_request()相同
+        r = requests.request('post', CLIENT._build_request_url('', None), json=bundle,
+                             headers=CLIENT._build_request_headers())
+    except requests.RequestException as e:
+        print("The batch request failed, the searches are sent one by one: {!r}".format(e))
+        return dict()
+
+    if r.status_code in BATCH_UNSUPPORTED_STATUSES:
+        print("The FHIR Server doesn't support batch: {} {}".format(r.status_code, r.content[:200]))
+        return None
+    if not 200 <= r.status_code < 300:
+        print("The batch request failed, the searches are sent one by one: {} {}".format(
+            r.status_code, r.content[:200]))
+        return dict()
+    try:
+        response = _loads_bundle(r.content) if r.content else None
+    except ValueError as e:
+        print("The batch response can't be decoded, the searches are sent one by one: {!r}".format(e))
+        return dict()
+
+    if not isinstance(response, dict) or response.get('resourceType') != 'Bundle' \
+            or response.get('type') != 'batch-response':
+        print("The FHIR Server doesn't answer the batch with a batch-response Bundle")
+        return None
+    if len(response.get('entry', [])) != len(searches):
+        print("The batch-response doesn't have an entry for every search, the searches are sent one by one")
+        return dict()
+
+    prefetched = dict()
+    for search, entry in zip(searches, response['entry']):
+        # 失敗的entry就不放進去，之後會再個別搜尋一次並回傳錯誤
+        status = str(get_by_path(entry, ['response', 'status'], ''))
+        if status.startswith('2') and get_by_path(entry, ['resource', 'resourceType']) == 'Bundle':
+            prefetched[_prefetch_key(search)] = entry['resource']
+    return prefetched
+
+
+def _loads_bundle(data: str or bytes) -> dict:
+    if RAW_RESOURCES:
+        return fast_json.loads(data)
+    return json.loads(data, object_hook=AttrDict)
+
+
+def _raw_response(status: int, content: bytes) -> dict or None:
+    # The same status handling as fhirpy's _do_request()
+    if 200 <= status < 300:
+        return _loads_bundle(content) if content else None
+    if status == 404 or status == 410:
+        raise ResourceNotFound(content.decode())
+    raise OperationOutcome(content.decode())
+
+
+def _fetch_bundle(path: str, params: dict = None, method: str = 'get', data: dict = None) -> dict:
+    """
+    CLIENT._do_request(), the bundle is decoded by fast_json if RAW_RESOURCES
+    """
+    if not RAW_RESOURCES:
+        return CLIENT._do_request(method, path, data=data, params=params)
+    r = requests.request(method, CLIENT._build_request_url(path, params), json=data,
+                         headers=CLIENT._build_request_headers())
+    return _raw_response(r.status_code, r.content)
+
+
+async def _async_fetch_bundle(path: str, params: dict = None) -> dict:
+    """
+    The same as _fetch_bundle(), with ASYNC_CLIENT
+    """
+    if not RAW_RESOURCES:
+        return await ASYNC_CLIENT._fetch_resource(path, params)
+    async with aiohttp.request('get', ASYNC_CLIENT._build_request_url(path, params),
+                               headers=ASYNC_CLIENT._build_request_headers()) as r:
+        return _raw_response(r.status, await r.read())
+
+
+def _bundle_resources(search, bundle: dict) -> list:
+    """
+    The resources of the search's resource type in the bundle,
+    the raw dicts of the entries if RAW_RESOURCES, otherwise SyncFHIRResource(search._get_bundle_resources())
+    """
+    if not RAW_RESOURCES:
+        return search._get_bundle_resources(bundle)
+    if bundle.get('resourceType') != 'Bundle':
+        raise InvalidResponse('Expected to receive Bundle but {0} received'.format(bundle.get('resourceType')))
+    return [entry['resource'] for entry in bundle.get('entry', [])
+            if entry['resource'].get('resourceType') == search.resource_type]
+
+
+def _iter_bundles(search, cache_key: str = None):
+    """
+    Yield the raw bundles of the search page by page, the next page is fetched only when it is needed.
+    Each page is served from SEARCH_CACHE if it was fetched before, otherwise it is fetched and stored as JSON.
+    The first page could also come from PREFETCHED_BUNDLES, the answers of a batch Bundle.
+    """
+    page = 0
+    next_link = None
+    while True:
+        bundle = None
+        page_key = None if cache_key is None or SEARCH_CACHE is None else "{}#{}".format(cache_key, page)
+        if page_key is not None:
+            cached_bundle = SEARCH_CACHE.get(page_key)
+            if cached_bundle is not None:
+                bundle = _loads_bundle(cached_bundle)
+
+        if bundle is None and next_link is None and PREFETCHED_BUNDLES.get() is not None:
+            bundle = PREFETCHED_BUNDLES.get().get(_prefetch_key(search))
+            if bundle is not None and page_key is not None:
+                SEARCH_CACHE.set(page_key, json.dumps(bundle))
+
+        if bundle is None:
+            if next_link:
+                bundle = _fetch_bundle(*parse_pagination_url(next_link))
+            else:
+                bundle = _fetch_bundle(search.resource_type, search.params)
+            if page_key is not None:
+                SEARCH_CACHE.set(page_key, json.dumps(bundle))
+
+        yield bundle
+
+        next_link = _next_link(bundle)
+        if not next_link:
+            break
+        page += 1
+
+
+def _next_link(bundle: dict) -> str or None:
+    return get_by_path(bundle, ['link', {'relation': 'next'}, 'url'])
+
+
+def _iter_resources(search, cache_key: str = None):
+    for bundle in _iter_bundles(search, cache_key):
+        for resource in _bundle_resources(search, bundle):
+            yield resource
+
+
+def _fetch_resources(search, cache_key: str = None) -> list:
+    # Only the first page, the same as search.fetch()
+    return _bundle_resources(search, next(_iter_bundles(search, cache_key)))
+
+
+def _first_page(search, cache_key: str = None) -> tuple:
+    """
+    @return: (the resources of the first page, the generator of the following bundles)
+    """
+    bundles = _iter_bundles(search, cache_key)
+    return _bundle_resources(search, next(bundles)), bundles
+
+
+def _page_resources(search, first_resources: list, bundles):
+    # The resources of the first page, then the following pages fetched only when they are needed
+    return itertools.chain(first_resources,
+                           (resource for bundle in bundles for resource in _bundle_resources(search, bundle)))
+
+
+def _as_async_search(search):
+    # The searches are built by the same builders as the sync path, then copied to ASYNC_CLIENT
+    return ASYNC_CLIENT.searchset_class(ASYNC_CLIENT, search.resource_type, copy.deepcopy(search.params))
+
+
+async def _async_iter_bundles(search, cache_key: str = None):
+    """
+    The same as _iter_bundles(), but the pages are fetched with ASYNC_CLIENT
+    """
+    page = 0
+    next_link = None
+    while True:
+        bundle = None
+        page_key = None if cache_key is None or SEARCH_CACHE is None else "{}#{}".format(cache_key, page)
+        if page_key is not None:
+            cached_bundle = SEARCH_CACHE.get(page_key)
+            if cached_bundle is not None:
+                bundle = _loads_bundle(cached_bundle)
+
+        if bundle is None:
+            if next_link:
+                bundle = await _async_fetch_bundle(*parse_pagination_url(next_link))
+            else:
+                bundle = await _async_fetch_bundle(search.resource_type, copy.deepcopy(search.params))
+            if page_key is not None:
+                SEARCH_CACHE.set(page_key, json.dumps(bundle))
+
+        yield bundle
+
+        next_link = _next_link(bundle)
+        if not next_link:
+            break
+        page += 1
+
+
+async def _async_first_bundle(search, cache_key: str = None) -> dict:
+    bundles = _async_iter_bundles(search, cache_key)
+    try:
+        return await bundles.__anext__()
+    finally:
+        await bundles.aclose()
+
+
+async def _async_fetch_resources(search, cache_key: str = None) -> list:
+    # Only the first page, the same as _fetch_resources()
+    return _bundle_resources(search, await _async_first_bundle(search, cache_key))
+
+
+async def _async_first_page(search, cache_key: str = None) -> tuple:
+    """
+    The same as _first_page(), the following bundles are an async generator
+    """
+    bundles = _async_iter_bundles(search, cache_key)
+    return _bundle_resources(search, await bundles.__anext__()), bundles
+
+
+async def _async_fetch_all_resources(search, cache_key: str = None) -> list:
+    # The aggregators read the resources synchronously, so all the pages are fetched before
+    resources = list()
+    async for bundle in _async_iter_bundles(search, cache_key):
+        resources.extend(_bundle_resources(search, bundle))
+    return resources
+
+
+def _chunk_ids(search, param: str, ids: list) -> list:
+    """
+    Split the ids into chunks, so the url of each search(param=id1,id2,...) is not longer than MAX_URL_LENGTH
+    """
+    # _count may be added to the search after it is chunked, so the space of _count is also kept
+    base_length = len("{}/{}?{}&{}=&_count={}&_format=json".format(
+        CLIENT.url, search.resource_type, encode_params(search.params), param, MAX_LATEST_PAGE_SIZE))
+    chunks = list()
+    chunk = list()
+    length = base_length
+    for resource_id in ids:
+        id_length = len(quote(resource_id)) + 1
+        if len(chunk) != 0 and length + id_length > MAX_URL_LENGTH:
+            chunks.append(chunk)
+            chunk = list()
+            length = base_length
+        chunk.append(resource_id)
+        length += id_length
+    if len(chunk) != 0:
+        chunks.append(chunk)
+    return chunks
+
+
+def _subject_id(resource) -> str:
+    # subject.reference is "Patient/<id>"
+    return str(resource['subject']['reference']).split('/')[-1]
+
+
+def _is_latest_only(table: dict) -> bool:
+    """
+    The 'latest' search type only needs the newest resource, so the search doesn't need to fetch the whole window.
+    """
+    return str(table['search_type']).capitalize() == 'Latest'
+
+
+def _is_window_summary(table: dict) -> bool:
+    """
+    The search types computed from the WindowArrays of the whole window(mean, count, first, slope, percentile, series)
+    """
+    search_type = str(table['search_type']).capitalize()
+    return search_type in WINDOW_SEARCH_TYPES or PERCENTILE_SEARCH_TYPE.fullmatch(search_type) is not None or \
+        SERIES_SEARCH_TYPE.fullmatch(search_type) is not None
+
+
+def _resource_not_found(code: str, data_time_since: str) -> ResourceNotFound:
+    return ResourceNotFound(
+        'Could not find the resources {code} under time {time}, no enough data for the patient'.format(
+            code=code,
+            time=data_time_since
+        )
+    )
+
+
+def _data_time_since(table: dict, default_time: datetime) -> str:
+    return (default_time - table['data_alive_time'].get_relativedelta()).strftime(FHIR_DATE_FORMAT)
 
 
 class Observation(ResourcesInterface, GetValueAndDatetimeInterface):
     def search(self, patient_id: str, table: dict, default_time: datetime, data_alive_time=None) -> Dict:
-        data_time_since = (default_time - relativedelta(
-            years=table['data_alive_time'].get_years(),
-            months=table['data_alive_time'].get_months(),
-            days=table['data_alive_time'].get_days(),
-            hours=table['data_alive_time'].get_hours(),
-            minutes=table['data_alive_time'].get_minutes(),
-            seconds=table['data_alive_time'].get_seconds()
-        )).strftime(FHIR_DATE_FORMAT)
+        """
+        The code search and the component-code search are sent at the same time, the resources matched by
+        Observation.code are used if there are any, otherwise the resources found in the component-code
+        (the same as searching the component-code after the code search found nothing, in one round trip).
+        """
+        data_time_since = _data_time_since(table, default_time)
         code = table['code']
 
-        resources = CLIENT.resources('Observation')
-        search = resources.search(
-            subject=patient_id,
-            date__ge=data_time_since,
-            code=code
-        ).sort('-date')
-        results = search.fetch()
-        is_in_component = False
-
-        if len(results) == 0:
+        code_search, component_search = (Observation._single_search(patient_id, table, default_time, is_in_component)
+                                         for is_in_component in (False, True))
+        # 每個search都用一份自己的context, 才看得到呼叫者設定的PREFETCHED_BUNDLES
+        component_future = _COMPONENT_SEARCH_EXECUTOR.submit(
+            contextvars.copy_context().run, _first_page, *component_search)
+        try:
+            resources, bundles = _first_page(*code_search)
+        finally:
+            # 等component-code的搜尋結束，同時進行的搜尋數量才不會超過呼叫者的限制
+            component_page = component_future.exception() or component_future.result()
+        search = code_search[0]
+        is_in_component = len(resources) == 0
+        if is_in_component:
+            if isinstance(component_page, Exception):
+                raise component_page
+            resources, bundles = component_page
+            search = component_search[0]
+
+        if len(resources) == 0:
             """
-            如果resources的長度為0，代表Server裡面沒有這個病患的code data，
-            可能是在component-code之中，所以再透過component-code去搜尋
+            如果兩個搜尋的結果都為0，代表資料庫中沒有此數據，回傳錯誤到前端(可能還可以想一些其他的解決方案)
             """
+            raise _resource_not_found(code, data_time_since)
+
+        if _is_latest_only(table):
+            # GetLatest只會用到最新的一筆資料，所以只跟Server要一筆
+            return FeatureData(resources, code if is_in_component else None, 'Observation')
+        # 其他的search type(如max, min)需要走過整個時間區間，所以一頁一頁地讀取，不把全部的resources存下來
+        return FeatureData(_page_resources(search, resources, bundles), code if is_in_component else None,
+                           'Observation')
 
-            search = resources.search(
-                subject=patient_id,
-                date__ge=data_time_since,
-                component_code=code
-            ).sort('-date')
-            results = search.fetch()
-            is_in_component = True
+    async def async_search(self, patient_id: str, table: dict, default_time: datetime, data_alive_time=None) -> Dict:
+        """
+        The same as search(), but the resources are fetched with ASYNC_CLIENT.
+        The non-latest search types get all the pages of the window as a list.
+        """
+        data_time_since = _data_time_since(table, default_time)
+        code = table['code']
+
+        searches = list()
+        for is_in_component in (False, True):
+            search, cache_key = Observation._single_search(patient_id, table, default_time, is_in_component)
+            searches.append((_as_async_search(search), cache_key))
+        pages = await asyncio.gather(*(_async_first_page(search, cache_key) for search, cache_key in searches),
+                                     return_exceptions=True)
+        try:
+            if isinstance(pages[0], Exception):
+                raise pages[0]
+            is_in_component = len(pages[0][0]) == 0
+            if is_in_component and isinstance(pages[1], Exception):
+                raise pages[1]
+            resources, bundles = pages[1] if is_in_component else pages[0]
+            if len(resources) == 0:
+                raise _resource_not_found(code, data_time_since)
+            if not _is_latest_only(table):
+                search = searches[1 if is_in_component else 0][0]
+                async for bundle in bundles:
+                    resources.extend(_bundle_resources(search, bundle))
+        finally:
+            for page in pages:
+                if not isinstance(page, Exception):
+                    await page[1].aclose()
+
+        return FeatureData(resources, code if is_in_component else None, 'Observation')
+
+    @staticmethod
+    def _window_result(results: list, code: str, data_time_since: str, only_latest: bool = False) -> Dict:
+        """
+        The FeatureData of the resources matched by Observation.code or by the component-code(sorted by -date),
+        the same as search(): if any resource is matched by Observation.code, only these resources are used,
+        otherwise all the resources are found in the component-code.
+        @param only_latest: only the newest resource of the chosen ones is kept
+        """
+        if len(results) == 0:
+            raise _resource_not_found(code, data_time_since)
+
+        code_results = (resource for resource in results if _coding_matches(_get_path(resource, CODING_PATH), code))
+        if only_latest:
+            latest = next(code_results, None)
+            is_in_component = latest is None
+            results = results[:1] if is_in_component else [latest]
+        else:
+            code_results = list(code_results)
+            is_in_component = len(code_results) == 0
+            if not is_in_component:
+                results = code_results
+
+        return FeatureData(results, code if is_in_component else None, 'Observation')
+
+    def build_search(self, patient_id: str, tables: Dict[str, dict], default_time: datetime,
+                     data_alive_time=None):
+        """
+        Return the first searches that search() or search_group() would send for the features,
+        so the searches could be sent in a batch Bundle before.
+        @return: list of SyncFHIRSearchSet
+        """
+        if len(tables) == 1 or not all(_is_latest_only(table) for table in tables.values()):
+            # The summaries of the same code and window(feature_table.plan_feature_searches()) share one search
+            return [Observation._single_search(patient_id, next(iter(tables.values())), default_time,
+                                               is_in_component)[0] for is_in_component in (False, True)]
+
+        data_time_since = _data_time_since(next(iter(tables.values())), default_time)
+        codes = ",".join(table['code'] for table in tables.values())
+        return [Observation._subjects_search(Observation._window_search(codes, data_time_since), [patient_id], tables)]
+
+    @staticmethod
+    def _window_search(code: str, data_time_since: str, code_param: str = 'combo_code'):
+        """
+        @param code_param: 'code', 'component_code', or 'combo_code'(the default) that searches
+                           Observation.code and Observation.component.code at once for the multi-code searches
+        """
+        return CLIENT.resources('Observation').search(
+            date__ge=data_time_since,
+            **{code_param: code}
+        ).sort('-date').elements(*OBSERVATION_ELEMENTS)
+
+    @staticmethod
+    def _single_search(patient_id: str, table: dict, default_time: datetime, is_in_component: bool = False):
+        data_time_since = _data_time_since(table, default_time)
+        search = Observation._window_search(
+            table['code'], data_time_since, 'component_code' if is_in_component else 'code').search(subject=patient_id)
+        if _is_latest_only(table):
+            search = search.limit(1)
+        return search, _search_cache_key(patient_id, 'Observation', table['code'], data_time_since, search)
 
-            if len(results) == 0:
+    @staticmethod
+    def _subjects_search(window_search, subjects: list, tables: Dict[str, dict]):
+        if all(_is_latest_only(table) for table in tables.values()):
+            # 每個病患的每個feature只需要最新的一筆，所以第一頁只拿每個病患的每個feature約兩筆的資料量
+            window_search = window_search.limit(min(MAX_LATEST_PAGE_SIZE, 2 * len(subjects) * len(tables)))
+        return window_search.search(subject=",".join(subjects))
+
+    def search_group(self, patient_id: str, tables: Dict[str, dict], default_time: datetime,
+                     data_alive_time=None) -> Dict[str, Dict]:
+        """
+        Search several Observation features with the same data_alive_time in one multi-code search,
+        then split the returned bundle back into each feature by the resource's coding.
+        @param tables: {feature name: feature's table}, all of the tables should have the same data_alive_time
+        @return: {feature name: {'resource', 'component_code', 'type'}}, the same as search()
+        """
+        if all(_is_window_summary(table) for table in tables.values()):
+            return Observation._window_group(
+                tables, Observation.search(self, patient_id, next(iter(tables.values())), default_time), default_time)
+
+        results = Observation.search_patients(self, [patient_id], tables, default_time, data_alive_time)[patient_id]
+        errors = {feature: result for feature, result in results.items() if isinstance(result, Exception)}
+        if len(errors) != 0:
+            raise FeatureSearchError(errors)
+        return results
+
+    @staticmethod
+    def _window_group(tables: Dict[str, dict], data: dict, default_time: datetime) -> Dict[str, Dict]:
+        """
+        The features of the group have the same code and data_alive_time, so they get the same WindowArrays
+        of the searched window, and it's loaded into the arrays only once for all of them
+        """
+        window = WindowArrays(data, _data_time_since(next(iter(tables.values())), default_time), default_time)
+        return {feature: FeatureData(window, window.component_code, 'Observation') for feature in tables}
+
+    def search_patients(self, patient_ids: list, tables: Dict[str, dict], default_time: datetime,
+                        data_alive_time=None) -> Dict[str, Dict[str, Dict or Exception]]:
+        """
+        Search the Observation features of many patients with subject=id1,id2,... and code=a,b,c,
+        then split the returned bundles back into each patient and feature.
+        The patient ids are chunked so the url is not longer than MAX_URL_LENGTH, one search for each chunk.
+        If all the features are 'latest', only the first page of each chunk is read, and the (patient, feature) that
+        are not matched by Observation.code in the first page are confirmed together by _search_waiting().
+        Otherwise the resources are kept as lists, not streamed.
+        @param tables: {feature name: feature's table}, all of the tables should have the same data_alive_time
+        @return: {patient id: {feature name: {'resource', 'component_code', 'type'} or the Exception of the feature}}
+        """
+        data_time_since = _data_time_since(next(iter(tables.values())), default_time)
+        codes = ",".join(table['code'] for table in tables.values())
+
+        search = Observation._window_search(codes, data_time_since)
+
+        only_latest = all(_is_latest_only(table) for table in tables.values())
+        code_results = {patient_id: {feature: [] for feature in tables} for patient_id in patient_ids}
+        component_results = {patient_id: {feature: [] for feature in tables} for patient_id in patient_ids}
+        waiting = set()
+        # The component indexes of this fetch, shared by the features of the same panel and their value reads
+        component_indexes = dict()
+        for subjects in _chunk_ids(search, 'subject', patient_ids):
+            subject_search = Observation._subjects_search(search, subjects, tables)
+            cache_key = _search_cache_key(",".join(subjects), 'Observation', codes, data_time_since, subject_search)
+            subject_waiting = {(patient_id, feature) for patient_id in subjects for feature in tables}
+            if only_latest:
                 """
-                如果再次搜尋後的結果依舊為0，代表資料庫中沒有此數據，回傳錯誤到前端(可能還可以想一些其他的解決方案)
+                'latest'只拿第一頁，沒有資料的病患會讓搜尋走過整個時間區間，
+                所以第一頁之後還沒找到的feature再一起確認
                 """
+                bundle = next(_iter_bundles(subject_search, cache_key))
+                Observation._split_resources(_bundle_resources(subject_search, bundle), tables, code_results,
+                                             component_results, subject_waiting, component_indexes)
+                if _next_link(bundle):
+                    waiting |= subject_waiting
+            else:
+                Observation._split_resources(_iter_resources(subject_search, cache_key), tables, code_results,
+                                             component_results, subject_waiting, component_indexes)
+
+        if len(waiting) != 0:
+            # component-code的搜尋只需要第一頁完全沒有找到的feature，與code的搜尋同時送出
+            component_waiting = {(patient_id, feature) for patient_id, feature in waiting
+                                 if len(component_results[patient_id][feature]) == 0}
+            component_future = _COMPONENT_SEARCH_EXECUTOR.submit(
+                contextvars.copy_context().run, Observation._search_waiting,
+                tables, component_waiting, 'component_code', data_time_since, component_results, component_indexes)
+            try:
+                Observation._search_waiting(tables, waiting, 'code', data_time_since, code_results)
+            finally:
+                component_future.result()
+
+        results = Observation._patients_results(
+            patient_ids, tables, code_results, component_results, data_time_since, component_indexes)
+        if all(_is_window_summary(table) for table in tables.values()):
+            # 同一個code與時間區間的summaries，每個病患只需要一份WindowArrays
+            for patient_id, patient_results in results.items():
+                data = next(iter(patient_results.values()))
+                if not isinstance(data, Exception):
+                    results[patient_id] = Observation._window_group(tables, data, default_time)
+        return results
+
+    async def async_search_group(self, patient_id: str, tables: Dict[str, dict], default_time: datetime,
+                                 data_alive_time=None) -> Dict[str, Dict]:
+        """
+        The same as search_group(), but the resources are fetched with ASYNC_CLIENT
+        """
+        if all(_is_window_summary(table) for table in tables.values()):
+            return Observation._window_group(
+                tables, await Observation.async_search(self, patient_id, next(iter(tables.values())), default_time),
+                default_time)
+
+        data_time_since = _data_time_since(next(iter(tables.values())), default_time)
+        codes = ",".join(table['code'] for table in tables.values())
+
+        search = Observation._subjects_search(Observation._window_search(codes, data_time_since), [patient_id], tables)
+        cache_key = _search_cache_key(patient_id, 'Observation', codes, data_time_since, search)
+        search = _as_async_search(search)
+
+        only_latest = all(_is_latest_only(table) for table in tables.values())
+        code_results = {patient_id: {feature: [] for feature in tables}}
+        component_results = {patient_id: {feature: [] for feature in tables}}
+        waiting = {(patient_id, feature) for feature in tables}
+        component_indexes = dict()
+        if only_latest:
+            bundle = await _async_first_bundle(search, cache_key)
+            resources = _bundle_resources(search, bundle)
+        else:
+            resources = await _async_fetch_all_resources(search, cache_key)
+        Observation._split_resources(resources, tables, code_results, component_results, waiting, component_indexes)
+
+        if only_latest and _next_link(bundle) and len(waiting) != 0:
+            component_waiting = {(patient_id, feature) for patient_id, feature in waiting
+                                 if len(component_results[patient_id][feature]) == 0}
+            await asyncio.gather(
+                Observation._async_search_waiting(tables, waiting, 'code', data_time_since, code_results),
+                Observation._async_search_waiting(tables, component_waiting, 'component_code', data_time_since,
+                                                  component_results, component_indexes))
+
+        results = Observation._patients_results(
+            [patient_id], tables, code_results, component_results, data_time_since, component_indexes)[patient_id]
+        errors = {feature: result for feature, result in results.items() if isinstance(result, Exception)}
+        if len(errors) != 0:
+            raise FeatureSearchError(errors)
+        return results
+
+    @staticmethod
+    def _split_resources(resources, tables: Dict[str, dict], code_results: dict, component_results: dict,
+                         waiting: set, component_indexes: dict):
+        """
+        Put each resource into the patient's and feature's list, by Observation.code or by the component-code,
+        the (patient id, feature name) found by Observation.code are discarded from waiting.
+        A feature only found in the component-code may still have older resources matched by Observation.code
+        beyond the first page of 'latest', so it's still waiting for _search_waiting().
+        @param component_indexes: the component indexes of the fetch, see _find_component()
+        """
+        for resource in resources:
+            patient_id = _subject_id(resource)
+            if patient_id not in code_results:
+                continue
+            for feature, table in tables.items():
+                if _coding_matches(_get_path(resource, CODING_PATH), table['code']):
+                    code_results[patient_id][feature].append(resource)
+                    waiting.discard((patient_id, feature))
+                elif _find_component(resource, table['code'], component_indexes) is not None:
+                    component_results[patient_id][feature].append(resource)
+
+    @staticmethod
+    def _waiting_search(tables: Dict[str, dict], waiting: set, code_param: str, data_time_since: str) -> tuple:
+        """
+        @return: (the waiting features, their patient ids, their codes, the search of the codes in code_param
+                 without subject)
+        """
+        features = [feature for feature in tables if any(pair[1] == feature for pair in waiting)]
+        patient_ids = list(dict.fromkeys(patient_id for patient_id, _ in waiting))
+        codes = ",".join(tables[feature]['code'] for feature in features)
+        search = Observation._window_search(codes, data_time_since, code_param).limit(MAX_LATEST_PAGE_SIZE)
+        return features, patient_ids, codes, search
 
-                raise ResourceNotFound(
-                    'Could not find the resources {code} under time {time}, no enough data for the patient'.format(
-                        code=code,
-                        time=data_time_since
-                    )
-                )
+    @staticmethod
+    def _take_newest(resources, tables: Dict[str, dict], features: list, waiting: set, code_param: str,
+                     results: dict, component_indexes: dict = None) -> bool:
+        """
+        Put the first(newest) resource matched in code_param of each waiting (patient id, feature name) into results,
+        and discard it from waiting.
+        @param component_indexes: the component indexes of the fetch, see _find_component()
+        @return: True if nothing is waiting anymore
+        """
+        for resource in resources:
+            patient_id = _subject_id(resource)
+            for feature in features:
+                if (patient_id, feature) not in waiting:
+                    continue
+                if code_param == 'code':
+                    matched = _coding_matches(_get_path(resource, CODING_PATH), tables[feature]['code'])
+                else:
+                    matched = _find_component(resource, tables[feature]['code'], component_indexes) is not None
+                if matched:
+                    results[patient_id][feature] = [resource]
+                    waiting.discard((patient_id, feature))
+            if len(waiting) == 0:
+                return True
+        return False
 
-        return {'resource': results, 'component_code': code if is_in_component else None,
-                'type': 'Observation'}
+    @staticmethod
+    def _search_waiting(tables: Dict[str, dict], waiting: set, code_param: str, data_time_since: str,
+                        results: dict, component_indexes: dict = None):
+        """
+        Find the newest resource of the (patient id, feature name) that the first page of 'latest' didn't resolve,
+        with one search of all their codes for all their patients(chunked by the url length), the pages are read
+        until every one of them is found or the window ends. The cost doesn't grow with the features × patients.
+        @param code_param: 'code' or 'component_code'
+        @param results: {patient id: {feature name: [resource]}}, the found ones are put into it
+        @param component_indexes: the component indexes of the fetch, see _find_component()
+        """
+        if len(waiting) == 0:
+            return
+        waiting = set(waiting)
+        features, patient_ids, codes, search = Observation._waiting_search(
+            tables, waiting, code_param, data_time_since)
+        for subjects in _chunk_ids(search, 'subject', patient_ids):
+            subject_search = search.search(subject=",".join(subjects))
+            cache_key = _search_cache_key(",".join(subjects), 'Observation', codes, data_time_since, subject_search)
+            subject_waiting = {pair for pair in waiting if pair[0] in subjects}
+            for bundle in _iter_bundles(subject_search, cache_key):
+                if Observation._take_newest(_bundle_resources(subject_search, bundle), tables, features,
+                                            subject_waiting, code_param, results, component_indexes):
+                    break
+
+    @staticmethod
+    async def _async_search_waiting(tables: Dict[str, dict], waiting: set, code_param: str, data_time_since: str,
+                                    results: dict, component_indexes: dict = None):
+        """
+        The same as _search_waiting(), with ASYNC_CLIENT
+        """
+        if len(waiting) == 0:
+            return
+        waiting = set(waiting)
+        features, patient_ids, codes, search = Observation._waiting_search(
+            tables, waiting, code_param, data_time_since)
+        for subjects in _chunk_ids(search, 'subject', patient_ids):
+            subject_search = search.search(subject=",".join(subjects))
+            cache_key = _search_cache_key(",".join(subjects), 'Observation', codes, data_time_since, subject_search)
+            subject_waiting = {pair for pair in waiting if pair[0] in subjects}
+            bundles = _async_iter_bundles(_as_async_search(subject_search), cache_key)
+            try:
+                async for bundle in bundles:
+                    if Observation._take_newest(_bundle_resources(subject_search, bundle), tables, features,
+                                                subject_waiting, code_param, results, component_indexes):
+                        break
+            finally:
+                await bundles.aclose()
+
+    @staticmethod
+    def _patients_results(patient_ids: list, tables: Dict[str, dict], code_results: dict, component_results: dict,
+                          data_time_since: str, component_indexes: dict) -> Dict[str, Dict[str, Dict or Exception]]:
+        results = dict()
+        for patient_id in patient_ids:
+            results[patient_id] = dict()
+            for feature, table in tables.items():
+                if len(code_results[patient_id][feature]) != 0:
+                    results[patient_id][feature] = FeatureData(code_results[patient_id][feature], None,
+                                                               'Observation')
+                elif len(component_results[patient_id][feature]) != 0:
+                    results[patient_id][feature] = FeatureData(component_results[patient_id][feature],
+                                                               table['code'], 'Observation', component_indexes)
+                else:
+                    results[patient_id][feature] = _resource_not_found(table['code'], data_time_since)
+        return results
 
     def get_datetime(self, dictionary: dict, default_time) -> str or None:
         try:
-            return _return_date_time_formatter(dictionary['resource'].effectiveDateTime)
+            return _return_date_time_formatter(_get_path(dictionary['resource'], EFFECTIVE_DATE_TIME_PATH))
         except KeyError:
             try:
-                return _return_date_time_formatter(dictionary['resource'].effectivePeriod.start)
+                return _return_date_time_formatter(_get_path(dictionary['resource'], EFFECTIVE_PERIOD_START_PATH))
             except KeyError:
                 return None
 
     def get_value(self, dictionary: dict) -> int or str:
         # Two situation: one is to get the value of resource, the other is to get the value of resource.component
         if dictionary['component_code'] is not None:
-            for component in dictionary['resource'].component:
-                for coding in component.code.coding:
-                    if coding.code == dictionary['component_code']:
-                        return component.valueQuantity.value
+            component = _find_component(dictionary['resource'], dictionary['component_code'],
+                                        dictionary.get('component_indexes'))
+            if component is not None:
+                return _get_path(component, VALUE_QUANTITY_PATH)
         else:
             try:
-                return dictionary['resource'].valueQuantity.value
+                return _get_path(dictionary['resource'], VALUE_QUANTITY_PATH)
             except KeyError:
-                return dictionary['resource'].valueString
+                return _get_path(dictionary['resource'], VALUE_STRING_PATH)
 
 
 class Condition(ResourcesInterface, GetValueAndDatetimeInterface):
     def search(self, patient_id: str, table: dict, default_time: datetime, data_alive_time=None) -> Dict:
+        return Condition._condition_result(_fetch_resources(*Condition._single_search(patient_id, table)))
+
+    async def async_search(self, patient_id: str, table: dict, default_time: datetime, data_alive_time=None) -> Dict:
+        search, cache_key = Condition._single_search(patient_id, table)
+        return Condition._condition_result(await _async_fetch_resources(_as_async_search(search), cache_key))
+
+    @staticmethod
+    def _condition_result(results: list) -> Dict:
+        # 如果result的長度為0，代表病人沒有這個症狀，那就回傳None, 否則回傳結果
+        # Consider: 如果這裡不回傳result, 而是回傳true or false，又會如何？
+        # Consider: 我有需要回傳整個result list嗎？還是只要回傳一個就好？有什麼情況需要我回傳整個list？計算染疫次數嗎？
+        return FeatureData(None if len(results) == 0 else results, None, 'Condition')
+
+    def build_search(self, patient_id: str, tables: Dict[str, dict], default_time: datetime,
+                     data_alive_time=None):
+        return [Condition._single_search(patient_id, next(iter(tables.values())))[0]]
+
+    @staticmethod
+    def _single_search(patient_id: str, table: dict):
         code = table['code']
 
         resources = CLIENT.resources('Condition')
@@ -330,18 +1417,46 @@ class Condition(ResourcesInterface, GetValueAndDatetimeInterface):
             subject=patient_id,
             code=code
         ).sort('recorded-date')
-        results = search.fetch()
+        return search, _search_cache_key(patient_id, 'Condition', code, None, search)
 
-        # 如果result的長度為0，代表病人沒有這個症狀，那就回傳None, 否則回傳結果
-        # Consider: 如果這裡不回傳result, 而是回傳true or false，又會如何？
-        # Consider: 我有需要回傳整個result list嗎？還是只要回傳一個就好？有什麼情況需要我回傳整個list？計算染疫次數嗎？
-        return {'resource': None if len(results) == 0 else results, 'component_code': None,
-                'type': 'Condition'}
+    def search_patients(self, patient_ids: list, tables: Dict[str, dict], default_time: datetime,
+                        data_alive_time=None) -> Dict[str, Dict[str, Dict]]:
+        """
+        Search the Condition features of many patients with subject=id1,id2,..., the same as Observation.
+        @return: {patient id: {feature name: {'resource', 'component_code', 'type'}}}
+        """
+        codes = ",".join(table['code'] for table in tables.values())
+
+        resources = CLIENT.resources('Condition')
+        search = resources.search(
+            code=codes
+        ).sort('recorded-date')
+
+        results = {patient_id: {feature: [] for feature in tables} for patient_id in patient_ids}
+        for subjects in _chunk_ids(search, 'subject', patient_ids):
+            subject_search = search.search(subject=",".join(subjects))
+            for resource in _iter_resources(subject_search, _search_cache_key(
+                    ",".join(subjects), 'Condition', codes, None, subject_search)):
+                patient_id = _subject_id(resource)
+                if patient_id not in results:
+                    continue
+                for feature, table in tables.items():
+                    if _coding_matches(_get_path(resource, CODING_PATH), table['code']):
+                        results[patient_id][feature].append(resource)
+
+        return {
+            patient_id: {
+                feature: Condition._condition_result(results[patient_id][feature])
+                for feature in tables
+            }
+            for patient_id in patient_ids
+        }
 
     def get_datetime(self, dictionary: dict, default_time) -> str or None:
         try:
-            return _return_date_time_formatter(dictionary['resource'].recordedDate)
-        except AttributeError:
+            return _return_date_time_formatter(_get_path(dictionary['resource'], RECORDED_DATE_PATH))
+        except TypeError:
+            # 沒有此病癥時resource為None
             return None
 
     def get_value(self, dictionary: dict) -> bool:
@@ -350,21 +1465,75 @@ class Condition(ResourcesInterface, GetValueAndDatetimeInterface):
 
 class Patient(ResourcesInterface, GetValueAndDatetimeInterface):
     def search(self, patient_id: str, table: dict, default_time: datetime, data_alive_time=None) -> Dict:
-        resources = CLIENT.resources('Patient')
-        search = resources.search(_id=patient_id).limit(1)
-        patient = search.get()
+        # Patient的出生日期不會改變，所以先從cache中找，找不到才向FHIR Server搜尋
+        patient = PATIENT_CACHE.get(patient_id)
+        if patient is None:
+            patients = _fetch_resources(Patient._single_search(patient_id))
+            if len(patients) == 0:
+                raise ResourceNotFound('No resources found')
+            patient = patients[0]
+            PATIENT_CACHE.set(patient_id, patient)
+
+        return Patient._patient_result(self, patient, table, default_time)
+
+    async def async_search(self, patient_id: str, table: dict, default_time: datetime, data_alive_time=None) -> Dict:
+        patient = PATIENT_CACHE.get(patient_id)
+        if patient is None:
+            patients = await _async_fetch_resources(_as_async_search(Patient._single_search(patient_id)))
+            if len(patients) == 0:
+                raise ResourceNotFound('No resources found')
+            patient = patients[0]
+            PATIENT_CACHE.set(patient_id, patient)
+
+        return Patient._patient_result(self, patient, table, default_time)
 
+    @staticmethod
+    def _patient_result(context: ResourceMgmt, patient, table: dict, default_time: datetime) -> Dict:
         result = None
         if table['code'] == 'age':
-            result = getattr(self._strategy, "get_{}".format(str(table['code']).lower()))(patient, default_time)
-        return {
-            "resource": result, "component_code": None, 'type': "Patient"
-        }
+            result = getattr(context.strategy, "get_{}".format(str(table['code']).lower()))(patient, default_time)
+        return FeatureData(result, None, 'Patient')
+
+    def build_search(self, patient_id: str, tables: Dict[str, dict], default_time: datetime,
+                     data_alive_time=None):
+        # 已經在cache中的Patient就不需要再搜尋了
+        if PATIENT_CACHE.get(patient_id) is not None:
+            return []
+        return [Patient._single_search(patient_id)]
+
+    @staticmethod
+    def _single_search(patient_id: str):
+        resources = CLIENT.resources('Patient')
+        return resources.search(_id=patient_id).limit(1)
+
+    def search_patients(self, patient_ids: list, tables: Dict[str, dict], default_time: datetime,
+                        data_alive_time=None) -> Dict[str, Dict[str, Dict or Exception]]:
+        """
+        Fetch the patients that are not in PATIENT_CACHE with _id=id1,id2,... and put them into the cache,
+        then every patient's features are computed by search() from the cache.
+        @return: {patient id: {feature name: {'resource', 'component_code', 'type'} or the Exception of the feature}}
+        """
+        resources = CLIENT.resources('Patient')
+        missing_patient_ids = [patient_id for patient_id in patient_ids if PATIENT_CACHE.get(patient_id) is None]
+        for ids in _chunk_ids(resources, '_id', missing_patient_ids):
+            for patient in _iter_resources(resources.search(_id=",".join(ids))):
+                PATIENT_CACHE.set(patient['id'], patient)
+
+        results = dict()
+        for patient_id in patient_ids:
+            results[patient_id] = dict()
+            for feature, table in tables.items():
+                try:
+                    results[patient_id][feature] = Patient.search(self, patient_id, table, default_time,
+                                                                  data_alive_time)
+                except Exception as e:
+                    results[patient_id][feature] = e
+        return results
 
     @staticmethod
     def get_age(patient: SyncFHIRResource, default_time) -> int:
         patient_birthdate = datetime.datetime.strptime(
-            patient.birthDate, FHIR_DATE_FORMAT)
+            patient['birthDate'], FHIR_DATE_FORMAT)
         # If we need to calculate the real age that is 1 year before or so (depends on the default_time)
         # , then calculate it by minus method.
         age = default_time - patient_birthdate
@@ -389,7 +1558,64 @@ class Patient(ResourcesInterface, GetValueAndDatetimeInterface):
             return dictionary['resource']
 
 
-def get_patient_resources(patient_id, table, default_time: datetime, data_alive_time=None) -> dict:
+class Aggregate(GetValueAndDatetimeInterface):
+    """
+    The date and value of the summaries computed by GetMean, GetCount, GetSlope, GetPercentile and GetSeries
+    """
+
+    def get_datetime(self, dictionary: dict, default_time: datetime) -> str or None:
+        return dictionary['resource']['date']
+
+    def get_value(self, dictionary: dict) -> int or float:
+        return dictionary['resource']['value']
+
+
+# The contexts bound to each strategy, shared by all the requests(the strategies are stateless)
+RESOURCE_MGMTS = {strategy.__name__: ResourceMgmt(strategy)
+                  for strategy in (Observation, Condition, Patient, Aggregate)}
+GET_FUNC_MGMTS = {strategy.__name__[len('Get'):]: GetFuncMgmt(strategy)
+                  for strategy in (GetLatest, GetMax, GetMin, GetMean, GetCount, GetFirst, GetSlope)}
+# e.g. 'percentile90', 'percentile_97.5'
+PERCENTILE_SEARCH_TYPE = re.compile(r'Percentile_?(\d+(?:\.\d+)?)')
+# e.g. 'series', 'series_1h', 'series_15min_ffill', 'series_1d'
+SERIES_SEARCH_TYPE = re.compile(r'Series(?:_(\d+)(min|h|d))?(_ffill)?')
+SERIES_INTERVAL_MINUTES = {'min': 1, 'h': 60, 'd': 24 * 60}
+# The search types that summarize the whole window, the features of the same code and window share one WindowArrays
+WINDOW_SEARCH_TYPES = frozenset(('Mean', 'Count', 'First', 'Slope'))
+
+
+def _get_func_mgmt(search_type: str) -> GetFuncMgmt or None:
+    """
+    @param search_type: the capitalized search_type, e.g. 'Latest', 'Percentile90'
+    @return: the GetFuncMgmt of the search_type, or None if the search_type is not supported
+    """
+    if search_type in GET_FUNC_MGMTS:
+        return GET_FUNC_MGMTS[search_type]
+    match = PERCENTILE_SEARCH_TYPE.fullmatch(search_type)
+    if match is not None and float(match.group(1)) <= 100:
+        return GetFuncMgmt(GetPercentile, float(match.group(1)))
+    match = SERIES_SEARCH_TYPE.fullmatch(search_type)
+    if match is not None:
+        number, unit, fill = match.groups()
+        interval = None if number is None else int(number) * SERIES_INTERVAL_MINUTES[unit]
+        # forward-fill只用在resample後的空bin
+        if interval == 0 or interval is None and fill is not None:
+            return None
+        return GetFuncMgmt(GetSeries, (interval, fill is not None))
+    return None
+
+
+def _resource_mgmt(type_of_data: str) -> ResourceMgmt:
+    # KeyError of the capitalized name if the type_of_data is not supported, the same as the globals() lookup before
+    return RESOURCE_MGMTS[str(type_of_data).capitalize()]
+
+
+def _table_resource_mgmt(table) -> ResourceMgmt:
+    # The compiled feature_table.FeaturePlan has its ResourceMgmt already
+    return getattr(table, 'resource_mgmt', None) or _resource_mgmt(table['type_of_data'])
+
+
+def get_patient_resources(patient_id, table, default_time: datetime, data_alive_time=None, store=None) -> dict:
     """
     The function will get the patient's resources from the database and return
     :param patient_id: patient's id
@@ -399,6 +1625,7 @@ def get_patient_resources(patient_id, table, default_time: datetime, data_alive_
     :param data_alive_time: the time range, start from the default_time.
                             e.g. if the data_alive_time is 2 years, and the default_time is not, the server will search
                                  the data that is between now and two years ago
+    :param store: base.feature_store.FeatureStore, read the resources from the local store instead of the FHIR Server
     :return: Dict, {"resource": SyncFHIRResources, "component-code": str or None,
                     "type": str(Resource name with capitalized)}
     """
@@ -412,9 +1639,12 @@ def get_patient_resources(patient_id, table, default_time: datetime, data_alive_
     Observation因為會有component-code的可能，所以相關程式碼會比較複雜
     Condition目前相對單純，就是使用時間大於等於條件與code等於多少就好了
     """
-    patient_resources_mgmt = ResourceMgmt()
-    patient_resources_mgmt.strategy = globals()[str(table["type_of_data"]).capitalize()]
-    patient_data_dict = patient_resources_mgmt.get_data_with_resources(patient_id, table, default_time, data_alive_time)
+    if store is not None:
+        patient_data_dict = store.search(patient_id, table, default_time)
+    else:
+        patient_resources_mgmt = _table_resource_mgmt(table)
+        patient_data_dict = patient_resources_mgmt.get_data_with_resources(
+            patient_id, table, default_time, data_alive_time)
 
     # 然後再根據不同的欲取得的資料設定(如最新的資料, 最大的資料, 最小的資料...)來從data_list中取得符合設定的data
     # 該設定可以在features.csv中的search_type column設定
@@ -425,40 +1655,182 @@ def get_patient_resources(patient_id, table, default_time: datetime, data_alive_
     NULL就是不做任何處置，會使用這個設定的數值有Patient age，
     因為在Patient resources中，age會直接計算出年齡並回傳結果，所以不用再取得數值了
     """
+    return _get_data_with_search_type(table, patient_data_dict, default_time)
+
+
+def get_grouped_patient_resources(patient_id, tables, default_time: datetime, data_alive_time=None) -> dict:
+    """
+    Same as get_patient_resources(), but the features in tables are searched together with one search.
+    The features should be in the same resource type and have the same data_alive_time,
+    for now only Observation supports the grouped search.
+    :param tables: {feature name: feature's table}
+    :return: {feature name: the same as get_patient_resources()}
+    """
+    first_table = next(iter(tables.values()))
+    patient_resources_mgmt = _table_resource_mgmt(first_table)
+    patient_data_dicts = patient_resources_mgmt.get_grouped_data_with_resources(
+        patient_id, tables, default_time, data_alive_time)
+
+    return _get_grouped_data_with_search_type(tables, patient_data_dicts, default_time)
+
+
+async def async_get_patient_resources(patient_id, table, default_time: datetime, data_alive_time=None) -> dict:
+    """
+    Same as get_patient_resources(), but the resources are fetched with ASYNC_CLIENT,
+    so many patients' searches could wait for the FHIR Server at the same time in one event loop.
+    """
+    patient_resources_mgmt = _table_resource_mgmt(table)
+    patient_data_dict = await patient_resources_mgmt.async_get_data_with_resources(
+        patient_id, table, default_time, data_alive_time)
+
+    return _get_data_with_search_type(table, patient_data_dict, default_time)
+
+
+async def async_get_grouped_patient_resources(patient_id, tables, default_time: datetime,
+                                              data_alive_time=None) -> dict:
+    """
+    Same as get_grouped_patient_resources(), but the resources are fetched with ASYNC_CLIENT
+    """
+    first_table = next(iter(tables.values()))
+    patient_resources_mgmt = _table_resource_mgmt(first_table)
+    patient_data_dicts = await patient_resources_mgmt.async_get_grouped_data_with_resources(
+        patient_id, tables, default_time, data_alive_time)
+
+    return _get_grouped_data_with_search_type(tables, patient_data_dicts, default_time)
+
+
+def get_patient_searches(patient_id, tables, default_time: datetime, data_alive_time=None):
+    """
+    Return the first searches that get_patient_resources() or get_grouped_patient_resources() would send
+    for the features, an empty list if nothing needs to be searched.
+    :param tables: {feature name: feature's table}
+    """
+    first_table = next(iter(tables.values()))
+    patient_resources_mgmt = _table_resource_mgmt(first_table)
+    return patient_resources_mgmt.get_search_with_resources(patient_id, tables, default_time, data_alive_time)
+
+
+def get_patient_index(patient_id, tables, data_time_since: str) -> dict:
+    """
+    Fetch the patient's resources of all the features at once, for answering the features of many default_times:
+    the Observations with date >= data_time_since, the Conditions and the Patient.
+    :param tables: {feature name: feature's table}
+    :return: {resource type: [resources]}, the same order as the searches(Observation by -date,
+             Condition by recorded-date)
+    """
+    index = {'Patient': [], 'Observation': [], 'Condition': []}
+    codes = {resource_type: ",".join(table['code'] for table in tables.values()
+                                     if str(table['type_of_data']).capitalize() == resource_type)
+             for resource_type in ('Observation', 'Condition')}
+
+    if codes['Observation'] != '':
+        # 整個時間區間都需要，所以每頁拿多一點，減少round trip
+        search = Observation._window_search(codes['Observation'], data_time_since).search(
+            subject=patient_id).limit(MAX_LATEST_PAGE_SIZE)
+        index['Observation'] = list(_iter_resources(search, _search_cache_key(
+            patient_id, 'Observation', codes['Observation'], data_time_since, search)))
+
+    if codes['Condition'] != '':
+        search = CLIENT.resources('Condition').search(subject=patient_id, code=codes['Condition']).sort('recorded-date')
+        index['Condition'] = list(_iter_resources(search, _search_cache_key(
+            patient_id, 'Condition', codes['Condition'], None, search)))
+
+    if any(str(table['type_of_data']).capitalize() == 'Patient' for table in tables.values()):
+        patient = PATIENT_CACHE.get(patient_id)
+        if patient is None:
+            patients = _fetch_resources(Patient._single_search(patient_id))
+            if len(patients) != 0:
+                patient = patients[0]
+                PATIENT_CACHE.set(patient_id, patient)
+        index['Patient'] = [] if patient is None else [patient]
+    return index
+
+
+def get_patients_resources(patient_ids, tables, default_time: datetime, data_alive_time=None) -> dict:
+    """
+    Same as get_grouped_patient_resources(), but for many patients, the features are searched once for all of them.
+    The error of a patient's feature doesn't stop the other patients, it is returned in the place of the result.
+    :param patient_ids: list of patient's id
+    :param tables: {feature name: feature's table}
+    :return: {patient id: {feature name: the same as get_patient_resources() or the Exception of the feature}}
+    """
+    first_table = next(iter(tables.values()))
+    patient_resources_mgmt = _table_resource_mgmt(first_table)
+    patients_data_dicts = patient_resources_mgmt.get_patients_data_with_resources(
+        patient_ids, tables, default_time, data_alive_time)
+
+    results = dict()
+    for patient_id in patient_ids:
+        results[patient_id] = dict()
+        for feature in tables:
+            patient_data_dict = patients_data_dicts[patient_id][feature]
+            if isinstance(patient_data_dict, Exception):
+                results[patient_id][feature] = patient_data_dict
+                continue
+            try:
+                results[patient_id][feature] = _get_data_with_search_type(tables[feature], patient_data_dict,
+                                                                          default_time)
+            except Exception as e:
+                results[patient_id][feature] = e
+    return results
+
+
+def _get_data_with_search_type(table, patient_data_dict, default_time: datetime = None) -> dict:
+    """
+    @param default_time: the window summaries(e.g. the grid of 'series') cover the window from data_time_since to
+                         default_time, None is the window from the oldest to the newest resource
+    """
     search_type = str(table['search_type']).capitalize()
 
     # 沒有輸入search_type的狀況: 如Patient的get_age
     if search_type == "":
         patient_resource_result = patient_data_dict
-    # 如果有輸入search_type，檢查是不是latest, min or max
-    # XXX: 希望能是寫活的，可以自動判別目前已經開發出來的Concrete getFuncInterface
-    elif search_type in ('Latest', 'Min', 'Max'):
-        patient_get_setting_mgmt = GetFuncMgmt()
-        patient_get_setting_mgmt.strategy = globals()["Get" + search_type]
-        patient_resource_result = patient_get_setting_mgmt.get_data_with_func(patient_data_dict)
+    # 如果有輸入search_type，從GET_FUNC_MGMTS找已經開發出來的Concrete getFuncInterface(percentile帶有參數)
     else:
-        raise AttributeError("'{}' search_type is not supported now, check it again.".format(table['search_type']))
+        patient_get_setting_mgmt = getattr(table, 'get_func_mgmt', None) or _get_func_mgmt(search_type)
+        if patient_get_setting_mgmt is None:
+            raise AttributeError(
+                "'{}' search_type is not supported now, check it again.".format(table['search_type']))
+        if default_time is not None and _is_window_summary(table) and \
+                not isinstance(patient_data_dict['resource'], WindowArrays):
+            window = WindowArrays(patient_data_dict, _data_time_since(table, default_time), default_time)
+            patient_data_dict = FeatureData(window, window.component_code, 'Observation')
+        patient_resource_result = patient_get_setting_mgmt.get_data_with_func(patient_data_dict)
 
     return patient_resource_result
 
 
+def _get_grouped_data_with_search_type(tables, patient_data_dicts, default_time: datetime = None) -> dict:
+    """
+    _get_data_with_search_type() of each feature in the group, the errors are kept with the feature that caused them
+    (e.g. only the slope of the window has not enough data, the mean of the same window is fine)
+    """
+    results = dict()
+    errors = dict()
+    for feature in tables:
+        try:
+            results[feature] = _get_data_with_search_type(tables[feature], patient_data_dicts[feature], default_time)
+        except Exception as e:
+            errors[feature] = e
+    if len(errors) != 0:
+        raise FeatureSearchError(errors)
+    return results
+
+
 def get_resource_datetime(data: Dict, default_time: datetime) -> str or None:
-    patient_resources_mgmt = ResourceMgmt()
-    patient_resources_mgmt.strategy = globals()[str(data['type']).capitalize()]
+    patient_resources_mgmt = _resource_mgmt(data['type'])
     data_datetime = patient_resources_mgmt.get_datetime_with_resources(data, default_time)
     return data_datetime
 
 
 def get_resource_value(data: Dict) -> int or float or str or bool:
-    patient_resources_mgmt = ResourceMgmt()
-    patient_resources_mgmt.strategy = globals()[str(data['type']).capitalize()]
+    patient_resources_mgmt = _resource_mgmt(data['type'])
     data_value = patient_resources_mgmt.get_value_with_resources(data)
     return data_value
 
 
 def get_resource_datetime_and_value(data: Dict, default_time: datetime) -> (str or None, int or float or str or bool):
-    patient_resources_mgmt = ResourceMgmt()
-    patient_resources_mgmt.strategy = globals()[str(data['type']).capitalize()]
+    patient_resources_mgmt = _resource_mgmt(data['type'])
     data_datetime = patient_resources_mgmt.get_datetime_with_resources(data, default_time)
     data_value = patient_resources_mgmt.get_value_with_resources(data)
     return data_datetime, data_value
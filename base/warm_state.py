@@ -0,0 +1,236 @@
+"""
+Warm feature state for monitoring: the patients that are scored again and again are kept in memory.
+
+The first request of a patient loads the model's window once, then a background refresher polls
+Observation?_lastUpdated=gt<watermark> (and Condition) for all the monitored patients and the model's codes,
+and merges only the new or changed resources into each patient's state. The requests are answered from memory,
+so the load of the FHIR Server grows with the new resources instead of the requests.
+
+The answers are the same as the live searches at the last refresh. Deleted resources are not seen by _lastUpdated,
+they are only dropped when the patient is loaded again(after the patient was idle for IDLE_TIMEOUT).
+"""
+import time
+import datetime
+import threading
+import configparser
+
+from base.exceptions import FeatureSearchError
+from base.searchesets_new import CLIENT
+from base.searchesets_new import MAX_LATEST_PAGE_SIZE
+from base.searchesets_new import OBSERVATION_ELEMENTS
+from base.searchesets_new import get_patient_index
+from base.searchesets_new import _chunk_ids
+from base.searchesets_new import _iter_resources
+from base.searchesets_new import _subject_id
+from base.searchesets_new import _data_time_since
+from base.searchesets_new import _get_data_with_search_type
+from base.bulk_export import _date_key
+from base.bulk_export import _effective_date
+from base.backfill import FeatureSeries
+from base.backfill import _search_series
+from base.patient_data_search import _get_result_dict
+
+config = configparser.ConfigParser()
+config.read("./config.ini")
+REFRESH_INTERVAL = config.getfloat('warm_state', 'REFRESH_INTERVAL', fallback=60)
+IDLE_TIMEOUT = config.getfloat('warm_state', 'IDLE_TIMEOUT', fallback=3600)
+# The watermark goes back a little, so the resources updated while polling are not missed(the merge is idempotent)
+WATERMARK_OVERLAP = config.getfloat('warm_state', 'WATERMARK_OVERLAP', fallback=5)
+
+
+def _watermark(poll_time: datetime.datetime) -> str:
+    return (poll_time - datetime.timedelta(seconds=WATERMARK_OVERLAP)).isoformat(timespec='seconds')
+
+
+def _data_time_since_all(table: dict, default_time: datetime.datetime) -> str or None:
+    return min((_data_time_since(feature, default_time) for feature in table.values()
+                if str(feature['type_of_data']).capitalize() == 'Observation'), default=None)
+
+
+def _codes(table: dict, resource_type: str) -> str:
+    # The compiled feature_table.ModelPlan has the codes of each resource type already
+    if hasattr(table, 'codes'):
+        return table.codes.get(resource_type, '')
+    return ",".join(feature['code'] for feature in table.values()
+                    if str(feature['type_of_data']).capitalize() == resource_type)
+
+
+class _PatientState:
+    """
+    The resources of one patient for one model, Observation and Condition are kept by id so the updated
+    resources replace the old ones
+    """
+
+    def __init__(self, patient_id: str, table: dict, index: dict, watermark: str):
+        self.patient_id = patient_id
+        self.table = table
+        self.watermark = watermark
+        self.last_used = time.monotonic()
+        self.patients = index['Patient']
+        self.observations = {resource['id']: resource for resource in index['Observation']}
+        self.conditions = {resource['id']: resource for resource in index['Condition']}
+        self._index = None
+        self._series = None
+        # The requests and the refresher of this patient wait for each other, not for the other patients
+        self.lock = threading.Lock()
+
+    def merge(self, resource_type: str, resources: list):
+        resources_by_id = self.observations if resource_type == 'Observation' else self.conditions
+        for resource in resources:
+            # 更新過的resource放到最後，與新的resource一起重新排序
+            resources_by_id.pop(resource['id'], None)
+            resources_by_id[resource['id']] = resource
+        if len(resources) != 0:
+            self._index = None
+
+    def prune(self, data_time_since: str):
+        # 已經不在任何feature時間區間內的Observation就不需要了
+        if data_time_since is None:
+            return
+        expired = [resource_id for resource_id, resource in self.observations.items()
+                   if _date_key(resource)[:len(data_time_since)] < data_time_since]
+        for resource_id in expired:
+            del self.observations[resource_id]
+        if len(expired) != 0:
+            self._index = None
+
+    def model_feature_search(self, default_time: datetime.datetime) -> dict:
+        if self._index is None:
+            # The same order as the searches: Observation by -date, Condition by recorded-date
+            index = {'Patient': self.patients,
+                     'Observation': sorted(self.observations.values(), key=_effective_date, reverse=True),
+                     'Condition': sorted(self.conditions.values(), key=lambda resource: resource.get('recordedDate', ''))}
+            component_indexes = dict()
+            self._series = {key: FeatureSeries(index['Observation'], feature['code'], component_indexes)
+                            for key, feature in self.table.items()
+                            if str(feature['type_of_data']).capitalize() == 'Observation'}
+            self._index = index
+
+        data = dict()
+        errors = dict()
+        for key, feature in self.table.items():
+            try:
+                data[key] = _get_data_with_search_type(
+                    feature, _search_series(self._index, self._series, key, feature, default_time), default_time)
+            except Exception as e:
+                errors[key] = e
+
+        if len(errors) != 0:
+            raise FeatureSearchError(errors)
+        return _get_result_dict(data, default_time)
+
+
+class WarmFeatureState:
+    def __init__(self, refresh_interval: float = REFRESH_INTERVAL, idle_timeout: float = IDLE_TIMEOUT):
+        self.refresh_interval = refresh_interval
+        self.idle_timeout = idle_timeout
+        # {(model name, patient id): _PatientState}, self._lock only guards the dict, each state has its own lock
+        self._states = dict()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def model_feature_search_with_patient_id(self, patient_id: str, model: str, table: dict) -> dict:
+        """
+        The same as patient_data_search.model_feature_search_with_patient_id() at now, answered from memory.
+        The patient is loaded from the FHIR Server at the first request, and monitored after that.
+        The patient is loaded again if the model's table is changed(the feature table was reloaded).
+        """
+        key = (model, patient_id)
+        with self._lock:
+            state = self._states.get(key)
+        if state is None or state.table is not table:
+            loaded_state = self._load(patient_id, table)
+            with self._lock:
+                state = self._states.get(key)
+                if state is None or state.table is not table:
+                    state = self._states[key] = loaded_state
+
+        with state.lock:
+            state.last_used = time.monotonic()
+            return state.model_feature_search(datetime.datetime.now())
+
+    def _load(self, patient_id: str, table: dict) -> _PatientState:
+        poll_time = datetime.datetime.now().astimezone()
+        index = get_patient_index(patient_id, table, _data_time_since_all(table, poll_time.replace(tzinfo=None)))
+        return _PatientState(patient_id, table, index, _watermark(poll_time))
+
+    def refresh(self):
+        """
+        Poll the new resources of all the monitored patients, one search(chunked by the url length) for each model's
+        feature table and resource type, and drop the patients that are idle longer than idle_timeout.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for key in [key for key, state in self._states.items() if now - state.last_used > self.idle_timeout]:
+                del self._states[key]
+            # The states of a model loaded before and after the feature table was reloaded have different tables
+            tables = dict()
+            for state in self._states.values():
+                tables.setdefault(id(state.table), (state.table, list()))[1].append(state)
+
+        for table, states in tables.values():
+            poll_time = datetime.datetime.now().astimezone()
+            watermark = min(state.watermark for state in states)
+            data_time_since = _data_time_since_all(table, poll_time.replace(tzinfo=None))
+            updates = {'Observation': self._poll_observations(states, table, watermark, data_time_since),
+                       'Condition': self._poll_conditions(states, table, watermark)}
+
+            for state in states:
+                with state.lock:
+                    for resource_type, resources in updates.items():
+                        state.merge(resource_type, resources.get(state.patient_id, []))
+                    state.prune(data_time_since)
+                    state.watermark = _watermark(poll_time)
+
+    @staticmethod
+    def _poll(search, patient_ids: list) -> dict:
+        updates = dict()
+        for subjects in _chunk_ids(search, 'subject', patient_ids):
+            for resource in _iter_resources(search.search(subject=",".join(subjects))):
+                updates.setdefault(_subject_id(resource), list()).append(resource)
+        return updates
+
+    def _poll_observations(self, states: list, table: dict, watermark: str, data_time_since: str) -> dict:
+        codes = _codes(table, 'Observation')
+        if codes == '':
+            return dict()
+        search = CLIENT.resources('Observation').search(
+            _lastUpdated='gt{}'.format(watermark),
+            date__ge=data_time_since,
+            combo_code=codes
+        ).elements(*OBSERVATION_ELEMENTS).limit(MAX_LATEST_PAGE_SIZE)
+        return self._poll(search, [state.patient_id for state in states])
+
+    def _poll_conditions(self, states: list, table: dict, watermark: str) -> dict:
+        codes = _codes(table, 'Condition')
+        if codes == '':
+            return dict()
+        search = CLIENT.resources('Condition').search(
+            _lastUpdated='gt{}'.format(watermark),
+            code=codes
+        ).limit(MAX_LATEST_PAGE_SIZE)
+        return self._poll(search, [state.patient_id for state in states])
+
+    def start(self):
+        """
+        Start the background refresher thread
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='warm-feature-refresher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                # 這次更新失敗就等下一次，已經在記憶體中的資料仍然可以使用
+                print("Warm feature refresh failed: {!r}".format(e))
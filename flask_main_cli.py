@@ -8,6 +8,8 @@ from flask import abort
 from flask_cors import CORS
 from base import feature_table
 from base import patient_data_search as ds
+from base.warm_state import WarmFeatureState
+from base.records import to_json
 from models import *
 
 app = Flask(__name__)
@@ -17,6 +19,15 @@ CORS(app)
 config = configparser.ConfigParser()
 config.read("./config.ini")
 table = feature_table.FeatureTable(config['table_path']['FEATURE_TABLE'])
+# features.csv改變時在背景重新載入，不需要重新啟動
+if config.getfloat('table_path', 'RELOAD_INTERVAL', fallback=0) > 0:
+    table.start_watching(config.getfloat('table_path', 'RELOAD_INTERVAL'))
+fetch_mode = config['fhir_server'].get('FETCH_MODE', 'serial')
+# 監測中的病患會一直被重新計算，開啟後就從記憶體中回答，並在背景更新新的資料
+warm_state = None
+if config.getboolean('warm_state', 'ENABLED', fallback=False):
+    warm_state = WarmFeatureState()
+    warm_state.start()
 
 
 def import_model():
@@ -66,11 +77,63 @@ def api_with_id(api):
     if request.values.get('data_alive_time') is not None:
         hour_alive_time = request.values.get('hour_alive_time')
 
-    patient_data_dictionary = ds.model_feature_search_with_patient_id(
-        patient_id, table.get_model_feature_dict(api), None, hour_alive_time)
+    if warm_state is not None:
+        patient_data_dictionary = warm_state.model_feature_search_with_patient_id(
+            patient_id, api, table.get_model_feature_dict(api))
+    else:
+        patient_data_dictionary = ds.model_feature_search_with_patient_id(
+            patient_id, table.get_model_feature_dict(api), None, hour_alive_time, fetch_mode)
     print(patient_data_dictionary)
     patient_data_dictionary["predict_value"] = return_model_result(patient_data_dictionary, api)
-    return jsonify(patient_data_dictionary)
+    return jsonify(to_json(patient_data_dictionary))
+
+
+@app.route('/<api>/batch', methods=['POST'])
+def api_with_ids(api):
+    """
+    Description:
+        This api gets the request with many patients' id and model, then the server would return the model's result
+        and the data of each patient. The features are searched once for all the patients.
+
+    :param api:<base>/<model name>/batch
+        {
+            "ids": [<patient's id>, ...]
+        }
+    :return: json object
+        {
+            "<patient's id>": {
+                "predict_value": <int> or <double>
+                "<feature's name>": {
+                    "date": YYYY-MM-DDThh:mm:ss,
+                    "value": <boolean> or <int> or <double> or <string> // depends on the data
+                }
+            },
+            "<patient's id>": {
+                "error": <string> // if the patient's data could not be found or predicted
+            }
+        }
+    """
+    request_json = request.get_json(silent=True) or dict()
+    # The body could be any JSON value, e.g. a list of the ids without the "ids" key
+    patient_ids = request_json.get('ids') if isinstance(request_json, dict) else None
+    if not isinstance(patient_ids, list) or len(patient_ids) == 0:
+        abort(400, description="Please fill in the list of patients' ID.")
+
+    patients_data_dictionary = ds.model_feature_search_with_patient_ids(
+        [str(patient_id) for patient_id in patient_ids], table.get_model_feature_dict(api))
+
+    response = dict()
+    for patient_id, patient_data_dictionary in patients_data_dictionary.items():
+        if isinstance(patient_data_dictionary, Exception):
+            response[patient_id] = {"error": str(patient_data_dictionary)}
+            continue
+        try:
+            patient_data_dictionary["predict_value"] = return_model_result(patient_data_dictionary, api)
+        except Exception as e:
+            response[patient_id] = {"error": str(e)}
+            continue
+        response[patient_id] = patient_data_dictionary
+    return jsonify(to_json(response))
 
 
 def verify_data(patient_data_dict, api):
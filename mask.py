@@ -1,6 +1,7 @@
 from mask_module import ConcreteMaskMart
 from mask_module import ConcreteMaskType
 from mask_module import ConcreteRegexSearch
+import os
 import pandas as pd
 
 unit_type = ("o2_flow_rate", "fio2")
@@ -77,13 +78,13 @@ if __name__ == '__main__':
     # mask()
     with open("./csv/A053_急診處置.csv", newline='') as csv_file:
         df = pd.read_csv(csv_file, encoding="utf-8")
-        for row in df.iterrows():
-            row = row[1]
-            txt = str(row.treatment_mining)
-            # txt = "MASK 10L/MIN->N/C 3L/MIN"
-
-            result = mask_mart.treatment_mining(txt)
-            if result:
-                print('txt= {}, \nresult= {}'.format(txt, result))
-                print("---------------------------")
+        # txt = "MASK 10L/MIN->N/C 3L/MIN"
+        results = mask_mart.treatment_mining_batch(df['treatment_mining'], processes=os.cpu_count())
+        results = results[results['mask_name'].notna()]
+        for txt, mask_name, mining_unit_type, value in zip(df.loc[results.index, 'treatment_mining'].astype(str),
+                                                           results['mask_name'], results['unit_type'],
+                                                           results['value'].tolist()):
+            result = {"mask_name": mask_name, "unit_type": mining_unit_type, "value": value}
+            print('txt= {}, \nresult= {}'.format(txt, result))
+            print("---------------------------")
     print("Done")
@@ -1,3 +1,4 @@
 from .mask_mart import ConcreteMaskMart
 from .mask_type import ConcreteMaskType
-from .regex import ConcreteRegexSearch
\ No newline at end of file
+from .regex import ConcreteRegexSearch
+from .regex_engine import CombinedRegexEngine
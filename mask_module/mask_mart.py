@@ -1,13 +1,38 @@
 from __future__ import annotations
+import re
+import sys
+import string
+import itertools
+import threading
+import concurrent.futures
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from typing import List
 from typing import Dict
 from typing import TYPE_CHECKING
 
+from .regex import regex_version
+from .regex import _changed
+from .regex_engine import CombinedRegexEngine
+from .regex_engine import _init_worker
+from .regex_engine import _search_chunk
+
 if TYPE_CHECKING:
     from mask_type import MaskType
 
 
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def treatment_memo_key(treatment_medication_text: str) -> str:
+    """
+    The memo key of the text, the ASCII letters in lower case.
+    The patterns are searched with re.IGNORECASE, so the case can't change the result, but the spaces, tabs and
+    newlines can(e.g. r"tracheal.*?(\d{1,2}) ?l" or "." not matching a newline), so they are kept as they are.
+    """
+    return treatment_medication_text.translate(_ASCII_LOWER)
+
+
 class MaskMart(ABC):
     """
     The Subject interface declares a set of methods for managing subscribers.
@@ -47,6 +72,22 @@ class ConcreteMaskMart(MaskMart):
     more comprehensively (categorized by event type, etc.).
     """
 
+    # (regex_version(), CombinedRegexEngine), compiled again when the subscribers or their patterns are changed
+    _engine = (None, None)
+
+    def __init__(self, memo_size: int = 4096):
+        """
+        @param memo_size: the number of the memo keys(treatment_memo_key()) kept by treatment_mining(),
+                          the least recently used one is dropped when it's full. 0 disables the memo.
+        """
+        self.memo_size = memo_size
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self._memo = OrderedDict()
+        # The memo is cleared when regex_version() is changed(mask types or patterns attached or detached)
+        self._memo_version = None
+        self._memo_lock = threading.Lock()
+
     def attach(self, observer: MaskType, index: int = 0) -> None:
         print("Subject: Attached an observer.")
         if observer in self._types:
@@ -55,10 +96,12 @@ class ConcreteMaskMart(MaskMart):
             self._types.insert(index - 1, observer)
         else:
             self._types.append(observer)
+        _changed()
 
     def detach(self, observer: MaskType) -> None:
         if observer in self._types:
             self._types.remove(observer)
+            _changed()
         else:
             print("The observer is not in the Subject.")
 
@@ -69,19 +112,20 @@ class ConcreteMaskMart(MaskMart):
     def notify(self, treatment_medication_request: str) -> Dict or None:
         """
         Trigger an update in each subscriber.
+        The subscribers' patterns are searched together by CombinedRegexEngine, with the same result as calling
+        the update() of each subscriber in turn.
         """
 
-        for observer in self._types:
-            observer_response = observer.update(treatment_medication_request)
-            if observer_response:
-                return {
-                    "mask_name": observer.name,
-                    "unit_type": observer_response["type"],
-                    "value": observer_response["value"]
-                }
-
         # If none of the observers match the treatment medication request, return None
-        return None
+        return self._combined_engine().search(treatment_medication_request)
+
+    def _combined_engine(self) -> CombinedRegexEngine:
+        version = regex_version()
+        engine_version, engine = self._engine
+        if engine_version != version:
+            engine = CombinedRegexEngine(self._types)
+            self._engine = (version, engine)
+        return engine
 
     def treatment_mining(self, treatment_medication_text: str) -> Dict or None:
         """
@@ -89,6 +133,103 @@ class ConcreteMaskMart(MaskMart):
         really do. Subjects commonly hold some important business logic, that
         triggers a notification method whenever something important is about to
         happen (or after it).
-        """
 
-        return self.notify(treatment_medication_text)
+        The text is mined as it is, and the result is memoized by treatment_memo_key() of the text,
+        so a repeated note costs a dict lookup.
+        """
+        if self.memo_size <= 0:
+            return self.notify(treatment_medication_text)
+
+        key = treatment_memo_key(treatment_medication_text)
+
+        version = regex_version()
+        with self._memo_lock:
+            if self._memo_version != version:
+                self._memo.clear()
+                self._memo_version = version
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                self.memo_hits += 1
+                return _copy_result(self._memo[key])
+            self.memo_misses += 1
+
+        result = self.notify(treatment_medication_text)
+        with self._memo_lock:
+            # 搜尋的時候patterns被改變的話就不存了
+            if self._memo_version == version == regex_version():
+                self._memo[key] = result
+                while len(self._memo) > self.memo_size:
+                    self._memo.popitem(last=False)
+        return _copy_result(result)
+
+    def memo_stats(self) -> dict:
+        with self._memo_lock:
+            requests = self.memo_hits + self.memo_misses
+            return {
+                "hits": self.memo_hits,
+                "misses": self.memo_misses,
+                "hit_rate": self.memo_hits / requests if requests != 0 else 0.0,
+                "size": len(self._memo),
+                "maxsize": self.memo_size,
+            }
+
+    def treatment_mining_batch(self, treatment_medication_texts, processes: int = None):
+        """
+        treatment_mining() of many texts at once, e.g. a column of the emergency treatment csv.
+        Each distinct text is mined once. Texts that don't contain the leading literal of any pattern
+        (CombinedRegexEngine.prefilter) are skipped without running the patterns.
+        The texts are mined as they are, the same as treatment_mining(), the memo isn't used.
+        @param treatment_medication_texts: pandas Series or list of texts, the values that are not str are converted
+                                           with str(), the same as str(row.treatment_mining)
+        @param processes: mine the texts in a process pool of this many workers, None or 1 runs in this process
+        @return: {"mask_name": list, "unit_type": list, "value": list}, None for the texts not matched.
+                 If the texts are a pandas Series, a DataFrame with the same index and the same columns
+                 (the value column is Int64)
+        """
+        engine = self._combined_engine()
+        # 傳進來的是Series的話pandas一定已經import了
+        pandas = sys.modules.get('pandas')
+        is_series = pandas is not None and isinstance(treatment_medication_texts, pandas.Series)
+        if is_series:
+            texts = treatment_medication_texts.astype(str)
+            unique_texts = pandas.Series(texts.unique())
+            if engine.prefilter is not None:
+                unique_texts = unique_texts[unique_texts.str.contains(engine.prefilter, flags=re.IGNORECASE)]
+            candidates = unique_texts.tolist()
+            texts = texts.tolist()
+        else:
+            texts = [text if isinstance(text, str) else str(text) for text in treatment_medication_texts]
+            candidates = list(dict.fromkeys(texts))
+            if engine.prefilter is not None:
+                prefilter = re.compile(engine.prefilter, re.IGNORECASE)
+                candidates = [text for text in candidates if prefilter.search(text)]
+
+        if processes is not None and processes > 1 and len(candidates) > 1:
+            # 每個worker只compile一次CombinedRegexEngine, 每個worker分到約4個chunk
+            chunk_size = -(-len(candidates) // (processes * 4))
+            chunks = [candidates[index:index + chunk_size] for index in range(0, len(candidates), chunk_size)]
+            with concurrent.futures.ProcessPoolExecutor(
+                    processes, initializer=_init_worker, initargs=(list(self._types),)) as executor:
+                responses = list(itertools.chain.from_iterable(executor.map(_search_chunk, chunks)))
+        else:
+            responses = [engine.search(text) for text in candidates]
+
+        found = dict(zip(candidates, responses))
+        results = {"mask_name": [], "unit_type": [], "value": []}
+        for text in texts:
+            response = found.get(text)
+            for key in results:
+                results[key].append(None if response is None else response[key])
+
+        if is_series:
+            return pandas.DataFrame({
+                "mask_name": results["mask_name"],
+                "unit_type": results["unit_type"],
+                "value": pandas.array(results["value"], dtype="Int64")
+            }, index=treatment_medication_texts.index)
+        return results
+
+
+def _copy_result(result: Dict or None) -> Dict or None:
+    # The memoized result is shared, so the caller gets its own copy
+    return None if result is None else dict(result)
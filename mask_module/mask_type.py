@@ -2,6 +2,8 @@ from __future__ import annotations
 from abc import ABC, abstractmethod
 from typing import TYPE_CHECKING
 
+from .regex import _changed
+
 if TYPE_CHECKING:
     from mask_mart import MaskMart
     from regex import RegexSearch
@@ -73,3 +75,4 @@ class ConcreteMaskType(MaskType):
     def attach_search_regex(self, *regex_searches: RegexSearch):
         for regex_search in regex_searches:
             self.regex_search_sets.append(regex_search)
+        _changed()
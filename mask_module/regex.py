@@ -2,6 +2,34 @@ from abc import ABC, abstractmethod
 import re
 
 
+# 任何RegexSearch、MaskType或MaskMart改變時就加一
+_version = 0
+
+
+def regex_version() -> int:
+    """
+    The version of all the regex searches, ConcreteMaskMart compiles its CombinedRegexEngine again when it's changed
+    """
+    return _version
+
+
+def _changed():
+    global _version
+    _version += 1
+
+
+def regex_value(result: str) -> int:
+    """
+    The number in the first group of the pattern, without the spaces, the liter unit and the percent sign
+    """
+    result = result \
+        .replace(" ", "") \
+        .replace("l", "") \
+        .replace("L", "") \
+        .replace("%", "")
+    return int(result)
+
+
 class RegexSearch(ABC):
     """
     The regex_search interface declares the regex search method and a list to store all the regex that it needs. Used for MaskObserver.
@@ -30,13 +58,7 @@ class ConcreteRegexSearch(RegexSearch):
 
                 regex = re.search(pattern, string, re.IGNORECASE)
                 if regex:
-                    result = regex.group(1)
-                    result = result \
-                        .replace(" ", "") \
-                        .replace("l", "") \
-                        .replace("L", "") \
-                        .replace("%", "")
-                    return int(result)
+                    return regex_value(regex.group(1))
         else:
             return None
 
@@ -47,14 +69,17 @@ class ConcreteRegexSearch(RegexSearch):
     @pattern.setter
     def pattern(self, pattern_string: str):
         self._regex_patterns.append(pattern_string)
+        _changed()
 
     @pattern.setter
     def pattern(self, pattern_list: list):
         self._regex_patterns.append(pattern_list)
+        _changed()
 
     def delete(self, pattern_string: str):
         if pattern_string in self._regex_patterns:
             self._regex_patterns.remove(pattern_string)
+            _changed()
             print(pattern_string + " deleted successfully")
         else:
             print(pattern_string + " is not in the list, please check again.")
@@ -0,0 +1,163 @@
+from __future__ import annotations
+import re
+from typing import List
+from typing import Dict
+from typing import TYPE_CHECKING
+
+from .regex import regex_value
+
+if TYPE_CHECKING:
+    from mask_type import ConcreteMaskType
+
+# 每個pattern前面加上lazy的任意字元, 在字串開頭match就等於re.search()找到最左邊的結果
+_BRANCH = r"(?s:.*?)(?P<p{}>{})"
+_SPECIAL_CHARACTERS = frozenset(".^$*+?{}[]()|")
+_QUANTIFIERS = frozenset("*?{")
+
+
+def _has_top_level_alternation(pattern: str) -> bool:
+    depth = 0
+    in_class = False
+    index = 0
+    while index < len(pattern):
+        character = pattern[index]
+        if character == "\\":
+            index += 1
+        elif in_class:
+            in_class = character != "]"
+        elif character == "[":
+            in_class = True
+            # []]或[^]]的第一個]是字元本身
+            if pattern[index + 1:index + 2] == "^":
+                index += 1
+            if pattern[index + 1:index + 2] == "]":
+                index += 1
+        elif character == "(":
+            depth += 1
+        elif character == ")":
+            depth -= 1
+        elif character == "|" and depth == 0:
+            return True
+        index += 1
+    return False
+
+
+def literal_prefix(pattern: str) -> str:
+    """
+    The literal characters at the start of the pattern, every text matched by the pattern contains them,
+    e.g. "nasal" of r"nasal.*?(\d{1,2})", "n/c" of r"n\/c.*?(\d{1,2})l\/min", "non" of r"non-?rebreath"
+    """
+    if _has_top_level_alternation(pattern):
+        return ""
+    prefix = ""
+    index = 0
+    while index < len(pattern):
+        character = pattern[index]
+        if character == "\\":
+            # \d, \s...是字元類別, 其他的(如\/)是跳脫的字元本身
+            if index + 1 >= len(pattern) or pattern[index + 1].isalnum():
+                break
+            character = pattern[index + 1]
+            index += 2
+        elif character in _SPECIAL_CHARACTERS:
+            break
+        else:
+            index += 1
+        if index < len(pattern) and pattern[index] in _QUANTIFIERS:
+            # 後面有?或*的字元可能不出現
+            break
+        prefix += character
+    return prefix
+
+
+class CombinedRegexEngine:
+    """
+    All the patterns of the mask types compiled into one alternation with a named group for each pattern,
+    in the priority of the Subject: mask type -> RegexSearch -> pattern.
+
+    The alternation is anchored at the start of the text and each branch starts with a lazy prefix, so the regex
+    tries every position of the first pattern before the second pattern, the same as calling re.search() with each
+    pattern in turn. The whole text is scanned once for all the mask types, and each "->" segment is scanned once
+    with the patterns of the mask type found.
+    """
+
+    def __init__(self, mask_types: List[ConcreteMaskType]):
+        branches = list()
+        self._type_regexes = dict()
+        for mask_type in mask_types:
+            if len(mask_type.regex_search_sets) == 0:
+                print("There are no search regex in the {} MaskObserver, it's skipped.".format(mask_type.name))
+                continue
+            type_branches = [(mask_type, regex_search, pattern)
+                             for regex_search in mask_type.regex_search_sets for pattern in regex_search.pattern]
+            self._type_regexes[mask_type] = self._compile(type_branches)
+            branches += type_branches
+        self._regex = self._compile(branches)
+
+        # 每個pattern開頭的字串, 一個都沒有出現的text就不可能match, 有pattern沒有開頭字串的話就不能先篩選
+        prefixes = [literal_prefix(pattern) for _, _, pattern in branches]
+        if all(prefixes):
+            self.prefilter = "|".join(re.escape(prefix) for prefix in dict.fromkeys(prefixes)) if prefixes else r"(?!)"
+        else:
+            self.prefilter = None
+
+    @staticmethod
+    def _compile(branches: list) -> tuple:
+        """
+        @return: (compiled regex, {index of the pattern's named group: (mask type, RegexSearch)})
+        """
+        regex = re.compile(r"^(?:{})".format("|".join(
+            _BRANCH.format(index, pattern) for index, (_, _, pattern) in enumerate(branches))) if branches else r"(?!)",
+            re.IGNORECASE)
+        return regex, {regex.groupindex["p{}".format(index)]: (mask_type, regex_search)
+                       for index, (mask_type, regex_search, _) in enumerate(branches)}
+
+    @staticmethod
+    def _search(compiled: tuple, text: str) -> tuple or None:
+        """
+        @return: (mask type, {"type": RegexSearch name, "value": int}) of the first pattern found, or None
+        """
+        regex, branches = compiled
+        match = regex.match(text)
+        if match is None:
+            return None
+        # 外層的named group最後結束，所以lastindex就是找到的pattern，pattern自己的第一個group接在後面
+        mask_type, regex_search = branches[match.lastindex]
+        return mask_type, {"type": regex_search.name, "value": regex_value(match.group(match.lastindex + 1))}
+
+    def search(self, treatment_medication_text: str) -> Dict or None:
+        """
+        The same result as calling ConcreteMaskType.update() of each mask type in turn
+        """
+        found = self._search(self._regex, treatment_medication_text)
+        if found is None:
+            return None
+        mask_type, response = found
+
+        # "->"之後的字串優先，從最後一段開始找這個mask type的patterns
+        treatment_medication_text_after_split = treatment_medication_text.split("->")
+        if len(treatment_medication_text_after_split) != 1:
+            for treatment_medication_text_split in reversed(treatment_medication_text_after_split):
+                found = self._search(self._type_regexes[mask_type], treatment_medication_text_split)
+                if found is not None:
+                    response = found[1]
+                    break
+
+        return {
+            "mask_name": mask_type.name,
+            "unit_type": response["type"],
+            "value": response["value"]
+        }
+
+
+# The CombinedRegexEngine of the worker process of treatment_mining_batch()
+_WORKER_ENGINE = None
+
+
+def _init_worker(mask_types: List[ConcreteMaskType]):
+    global _WORKER_ENGINE
+    _WORKER_ENGINE = CombinedRegexEngine(mask_types)
+
+
+def _search_chunk(treatment_medication_texts: List[str]) -> List[Dict or None]:
+    return [_WORKER_ENGINE.search(text) for text in treatment_medication_texts]
@@ -0,0 +1,106 @@
+"""
+The search types computed from the resources of a window, with the resources as the raw dicts of a bundle.
+Run from the repository root(config.ini is read from the working directory): python -m pytest tests
+"""
+import datetime
+
+import numpy
+import pytest
+
+from base.feature_table import DataAliveTime
+from base.records import FeatureData
+from base.searchesets_new import _get_data_with_search_type
+from base.searchesets_new import get_resource_datetime_and_value
+
+CODE = 'http://loinc.org|8867-4'
+COMPONENT_CODE = 'http://loinc.org|8462-4'
+
+
+def _observation(resource_id: str, date: str, value=None) -> dict:
+    resource = {'resourceType': 'Observation', 'id': resource_id, 'subject': {'reference': 'Patient/p1'},
+                'code': {'coding': [{'system': 'http://loinc.org', 'code': '8867-4'}]},
+                'effectiveDateTime': date}
+    if value is None:
+        resource['dataAbsentReason'] = {'coding': [{'code': 'not-performed'}]}
+    else:
+        resource['valueQuantity'] = {'value': value}
+    return resource
+
+
+def _panel(resource_id: str, date: str, value=None) -> dict:
+    component = {'code': {'coding': [{'system': 'http://loinc.org', 'code': '8462-4'}]}}
+    if value is not None:
+        component['valueQuantity'] = {'value': value}
+    return {'resourceType': 'Observation', 'id': resource_id, 'subject': {'reference': 'Patient/p1'},
+            'code': {'coding': [{'system': 'http://loinc.org', 'code': '85354-9'}]},
+            'effectiveDateTime': date, 'component': [component]}
+
+
+# Sorted by -date as the searches return them, the second one has no value
+WINDOW = [_observation('o1', '2021-10-18T09:00:00', 72),
+          _observation('o2', '2021-10-18T08:00:00'),
+          _observation('o3', '2021-10-18T06:00:00', 90),
+          _observation('o4', '2021-10-18T05:00:00', 60)]
+PANELS = [_panel('o1', '2021-10-18T09:00:00', 80),
+          _panel('o2', '2021-10-18T08:00:00'),
+          _panel('o3', '2021-10-18T06:00:00', 95)]
+
+
+def _date_and_value(search_type: str, resources: list, component_code: str = None,
+                    component_indexes: dict = None, default_time: datetime.datetime = None) -> tuple:
+    table = {'search_type': search_type, 'data_alive_time': DataAliveTime('0000-00-02T00:00:00')}
+    data = _get_data_with_search_type(table, FeatureData(iter(resources), component_code, 'Observation',
+                                                         component_indexes), default_time)
+    return get_resource_datetime_and_value(data, None)
+
+
+@pytest.mark.parametrize('search_type, value, date', [('max', 90, '2021-10-18T06:00'),
+                                                      ('min', 60, '2021-10-18T05:00')])
+def test_extreme_skips_the_observation_without_value(search_type, value, date):
+    assert _date_and_value(search_type, WINDOW) == (date, value)
+
+
+@pytest.mark.parametrize('search_type, value', [('max', 95), ('min', 80)])
+def test_extreme_skips_the_component_without_value(search_type, value):
+    assert _date_and_value(search_type, PANELS, COMPONENT_CODE)[1] == value
+
+
+def test_component_values_use_the_indexes_of_the_fetch():
+    # The features of the same fetch share the indexes, each panel is indexed only once
+    component_indexes = dict()
+    assert _date_and_value('max', PANELS, COMPONENT_CODE, component_indexes)[1] == 95
+    indexes = {key: entry[1] for key, entry in component_indexes.items()}
+    assert len(indexes) == len(PANELS)
+    assert _date_and_value('mean', PANELS, COMPONENT_CODE, component_indexes)[1] == 87.5
+    assert len(component_indexes) == len(PANELS)
+    assert all(component_indexes[key][1] is indexes[key] for key in indexes)
+
+
+@pytest.mark.parametrize('search_type, value', [('mean', 74.0),
+                                                ('count', 4),
+                                                ('slope', pytest.approx(12 / 13)),
+                                                ('percentile90', pytest.approx(86.4))])
+def test_window_summaries_skip_the_observation_without_value(search_type, value):
+    assert _date_and_value(search_type, WINDOW) == ('2021-10-18T09:00', value)
+
+
+def test_first_of_the_window_with_an_observation_without_value():
+    assert _date_and_value('first', WINDOW) == ('2021-10-18T05:00', 60)
+
+
+def test_series_of_the_window_with_an_observation_without_value():
+    date, series = _date_and_value('series_1h_ffill', WINDOW)
+    assert date == '2021-10-18T09:00'
+    assert series.values.tolist() == [60, 90, 90, 90, 72]
+
+
+@pytest.mark.parametrize('search_type, values', [('series_1h', [60, 90, None, None, 72, None, None, None]),
+                                                 ('series_1h_ffill', [60, 90, 90, 90, 72, 72, 72, 72])])
+def test_series_covers_the_whole_window(search_type, values):
+    # The window of two days is from 2021-10-16T00:00 to default_time, one bin for every hour
+    series = _date_and_value(search_type, WINDOW, default_time=datetime.datetime(2021, 10, 18, 12, 0))[1]
+    assert len(series) == 2 * 24 + 12 + 1
+    assert series.to_json()['start'] == '2021-10-16T00:00'
+    # The bins before the first value are empty, even if they are forward-filled
+    assert numpy.isnan(series.values[:2 * 24 + 5]).all()
+    assert series.to_json()['values'][2 * 24 + 5:] == values
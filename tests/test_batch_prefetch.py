@@ -0,0 +1,131 @@
+"""
+The batch fetch mode against a stand-in FHIR server: which failures of the batch POST turn batch off for the server,
+and which ones only fall back to the GET searches for the current call.
+Run from the repository root(config.ini is read from the working directory): python -m pytest tests
+"""
+import json
+import datetime
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+from fhirpy import SyncFHIRClient
+
+import base.searchesets_new as searchesets_new
+import base.patient_data_search as patient_data_search
+from base.feature_table import DataAliveTime
+
+CODE = 'http://loinc.org|8867-4'
+DEFAULT_TIME = datetime.datetime(2021, 10, 18, 12, 0)
+OBSERVATION = {
+    'resourceType': 'Observation', 'id': 'o1', 'subject': {'reference': 'Patient/p1'},
+    'code': {'coding': [{'system': 'http://loinc.org', 'code': '8867-4'}]},
+    'effectiveDateTime': '2021-10-18T09:49:08', 'valueQuantity': {'value': 72},
+}
+SEARCHSET = {'resourceType': 'Bundle', 'type': 'searchset', 'entry': [{'resource': OBSERVATION}]}
+
+
+class _StandInServer(BaseHTTPRequestHandler):
+    # (status, body) of the batch POST, set by each test
+    batch_reply = (200, None)
+    requests = []
+
+    def _reply(self, status: int, body):
+        content = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/fhir+json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.requests.append('GET')
+        self._reply(200, SEARCHSET)
+
+    def do_POST(self):
+        self.requests.append('POST')
+        bundle = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        status, body = self.batch_reply
+        if body is None:
+            body = {'resourceType': 'Bundle', 'type': 'batch-response',
+                    'entry': [{'response': {'status': '200 OK'}, 'resource': SEARCHSET} for _ in bundle['entry']]}
+        self._reply(status, body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _StandInServer)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    client = SyncFHIRClient('http://127.0.0.1:{}/fhir'.format(httpd.server_address[1]))
+    monkeypatch.setattr(searchesets_new, 'CLIENT', client)
+    monkeypatch.setattr(patient_data_search, 'CLIENT', client)
+    monkeypatch.setattr(searchesets_new, 'SEARCH_CACHE', None)
+    monkeypatch.setattr(patient_data_search, '_BATCH_UNSUPPORTED_SERVERS', set())
+    _StandInServer.batch_reply = (200, None)
+    _StandInServer.requests = []
+    yield client
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _table() -> dict:
+    return {'heart_rate': {'code': CODE, 'type_of_data': 'observation', 'search_type': 'latest',
+                           'data_alive_time': DataAliveTime('0000-00-02T00:00:00'), 'default_value': ''}}
+
+
+def _search():
+    return patient_data_search.model_feature_search_with_patient_id('p1', _table(), DEFAULT_TIME, fetch_mode='batch')
+
+
+def test_batch_response_is_used(server):
+    assert _search()['heart_rate']['value'] == 72
+    assert _StandInServer.requests == ['POST']
+
+
+@pytest.mark.parametrize('status', [503, 500, 413, 400])
+def test_transient_failure_only_falls_back_for_the_call(server, status):
+    _StandInServer.batch_reply = (status, {'resourceType': 'OperationOutcome'})
+    assert _search()['heart_rate']['value'] == 72
+    # The code search and the component-code search of the feature
+    assert _StandInServer.requests == ['POST', 'GET', 'GET']
+    assert server.url not in patient_data_search._BATCH_UNSUPPORTED_SERVERS
+
+    # The server recovered, the next call sends the batch again
+    _StandInServer.batch_reply = (200, None)
+    _StandInServer.requests = []
+    assert _search()['heart_rate']['value'] == 72
+    assert _StandInServer.requests == ['POST']
+
+
+@pytest.mark.parametrize('reply', [(404, {'resourceType': 'OperationOutcome'}),
+                                   (405, {'resourceType': 'OperationOutcome'}),
+                                   (501, {'resourceType': 'OperationOutcome'}),
+                                   (200, {'resourceType': 'Bundle', 'type': 'searchset', 'entry': []}),
+                                   (200, {'resourceType': 'OperationOutcome'})])
+def test_unsupported_batch_is_remembered(server, reply):
+    _StandInServer.batch_reply = reply
+    assert _search()['heart_rate']['value'] == 72
+    assert server.url in patient_data_search._BATCH_UNSUPPORTED_SERVERS
+
+    _StandInServer.requests = []
+    assert _search()['heart_rate']['value'] == 72
+    assert _StandInServer.requests == ['GET', 'GET']
+
+
+def test_undecodable_response_only_falls_back_for_the_call(server):
+    _StandInServer.batch_reply = (200, b'{"resourceType": "Bun')
+    assert _search()['heart_rate']['value'] == 72
+    assert server.url not in patient_data_search._BATCH_UNSUPPORTED_SERVERS
+
+
+def test_connection_error_falls_back(server, monkeypatch):
+    def refuse(*args, **kwargs):
+        raise searchesets_new.requests.ConnectionError('connection refused')
+
+    search = searchesets_new.Observation._single_search('p1', _table()['heart_rate'], DEFAULT_TIME)[0]
+    monkeypatch.setattr(searchesets_new.requests, 'request', refuse)
+    assert searchesets_new.prefetch_searches_with_batch([search]) == dict()